@@ -0,0 +1,171 @@
+#Copyright 2015 Skytap Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: skytap
+    plugin_type: inventory
+    short_description: Skytap environments as an Ansible inventory source
+    description:
+        - Builds the same hosts, groups and hostvars as skytap_inventory.py, but in-process, without a
+          subprocess or a JSON round trip, and cached with any Ansible cache plugin.
+        - Settings not given here are read from skytap.ini (settings_file, else $SKYTAP_INI or the skytap.ini
+          next to skytap_inventory.py), and SKYTAP_* environment variables over-ride both, as they do for the script.
+        - The config file name must end in skytap.yml or skytap.yaml.
+    extends_documentation_fragment:
+        - inventory_cache
+        - constructed
+    options:
+        plugin:
+            description: token that ensures this is a source file for the skytap plugin.
+            required: true
+            choices: ['skytap']
+        settings_file:
+            description:
+                - skytap.ini to read any settings not given in this file from.
+                - Defaults to $SKYTAP_INI, or the skytap.ini next to skytap_inventory.py, as for the script.
+            type: path
+        username:
+            description: Skytap API username.
+            env:
+                - name: SKYTAP_USERNAME
+        api_token:
+            description: Skytap API token.
+            env:
+                - name: SKYTAP_API_TOKEN
+        base_url:
+            description: Skytap API base url.
+        configuration_id:
+            description: Skytap environment id(s); each gets its own group when several are listed.
+            type: list
+            elements: str
+        network_type:
+            description: private, nat_vpn or nat_icnr (or several of them), as in skytap.ini.
+            type: list
+            elements: str
+        network_connection_id:
+            description: VPN or ICNR tunnel id to take NAT addresses from.
+        use_api_credentials:
+            description: set ansible_ssh_user/ansible_ssh_pass from the VMs' credentials.
+            type: bool
+        skytap_vm_username:
+            description: which of a VM's credentials to use.
+        api_credential_delimiter:
+            description: separator between user and password in a VM's credentials.
+        runtime_vars:
+            description: any of skytap.ini's [skytap_runtime_vars] (discover_name, max_workers, enrich_resources, ...).
+            type: dict
+            default: {}
+'''
+
+EXAMPLES = '''
+# skytap.yml
+plugin: skytap
+configuration_id: [1234567]
+network_type: [nat_vpn]
+cache: true
+cache_plugin: jsonfile
+cache_connection: ~/.ansible/tmp/skytap-inventory
+cache_timeout: 300
+keyed_groups:
+  - key: ansible_ssh_user | default('none')
+    prefix: ssh_user
+compose:
+  ansible_host: ansible_ssh_host
+'''
+
+import os
+import sys
+
+from ansible.errors import AnsibleError
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable, Constructable
+
+try:
+    import skytap_inventory
+except ImportError:
+    #not installed: use the copy this plugin ships next to
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import skytap_inventory
+
+
+class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
+
+    NAME = 'skytap'
+
+    def verify_file(self, path):
+        return super(InventoryModule, self).verify_file(path) and path.endswith(('skytap.yml', 'skytap.yaml'))
+
+    def skytap_inventory(self):
+        """a SkytapInventory for this source's options"""
+        configuration_id = self.get_option('configuration_id')
+        network_type = self.get_option('network_type')
+        settings = {"skytap_vars": {"base_url": self.get_option('base_url')},
+                    "skytap_env_vars": {"network_type": u",".join(network_type) if network_type else None,
+                                        "network_connection_id": self.get_option('network_connection_id'),
+                                        "use_api_credentials": self.get_option('use_api_credentials'),
+                                        "skytap_vm_username": self.get_option('skytap_vm_username'),
+                                        "api_credential_delimiter": self.get_option('api_credential_delimiter')},
+                    "skytap_runtime_vars": self.get_option('runtime_vars')}
+        return skytap_inventory.SkytapInventory(u",".join(configuration_id) if configuration_id else None,
+                                                self.get_option('username'), self.get_option('api_token'),
+                                                self.get_option('settings_file'), settings=settings)
+
+    def populate(self, results):
+        """add the groups and hosts of a script-format inventory, then the constructed groups and vars"""
+        strict = self.get_option('strict')
+        for group_name, group in results.items():
+            if group_name == u"_meta":
+                continue
+            self.inventory.add_group(group_name)
+            for var, value in group.get(u"vars", {}).items():
+                self.inventory.set_variable(group_name, var, value)
+            for hostname in group[u"hosts"]:
+                self.inventory.add_host(hostname, group=group_name)
+
+        for hostname, hostvars in results[u"_meta"][u"hostvars"].items():
+            self.inventory.add_host(hostname)
+            for var, value in hostvars.items():
+                self.inventory.set_variable(hostname, var, value)
+            self._set_composite_vars(self.get_option('compose'), hostvars, hostname, strict=strict)
+            self._add_host_to_composed_groups(self.get_option('groups'), hostvars, hostname, strict=strict)
+            self._add_host_to_keyed_groups(self.get_option('keyed_groups'), hostvars, hostname, strict=strict)
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        self._read_config_data(path)
+
+        cache_key = self.get_cache_key(path)
+        #cache=False is Ansible asking for a refresh (--flush-cache, meta: refresh_inventory)
+        user_cache_setting = self.get_option('cache')
+        attempt_to_read_cache = user_cache_setting and cache
+        cache_needs_update = user_cache_setting and not cache
+
+        results = None
+        if attempt_to_read_cache:
+            try:
+                results = self._cache[cache_key]
+            except KeyError:
+                cache_needs_update = True
+
+        if results is None:
+            try:
+                results = self.skytap_inventory().get_inventory()
+            except Exception as error:
+                raise AnsibleError("failed to build the Skytap inventory: %s" % error)
+        if cache_needs_update:
+            self._cache[cache_key] = results
+
+        self.populate(results)
@@ -15,42 +15,426 @@
 #limitations under the License.
 
 
+#only json/os/sys/time are imported up front: answering from the fast-start record needs nothing else.  
+#everything heavier (requests, six, configparser, threading...) is imported where it is used.
 import json
-import logging
 import os 
-import six
-from six.moves import configparser
+import sys
+import time
 
-import requests
-from requests.adapters import HTTPAdapter
-
-from urlparse import urljoin, urlunsplit
-from urllib import urlencode
+#the inventory plugin runs inside Ansible's own interpreter, which is usually Python 3
+if sys.version_info[0] >= 3:
+    unicode = str
 
 RESOURCE_NAME = "configurations"
 DEFAULT_BASE_URL = "https://cloud.skytap.com/v2/" 
-LOG = logging.getLogger(__name__)
+DEFAULT_CACHE_PATH = "~/.ansible/tmp/skytap"
+DEFAULT_DAEMON_SOCKET = "~/.ansible/tmp/skytap/inventory.sock"
+DEFAULT_CONTROL_PATH = "~/.ansible/cp/skytap-%C"
+DAEMON_CLIENT_TIMEOUT = 5
+FAST_START_FILE = "last-inventory.json"
+
+
+class LazyLogger(object):
+    """stands in for the module logger; logging is only imported once something is logged"""
+    def __getattr__(self, name):
+        import logging
+        return getattr(logging.getLogger(__name__), name)
+
+LOG = LazyLogger()
+
+
+def expand_path(path):
+    """expand ~ and $VARS, the same way for every path taken from settings or the environment"""
+    return os.path.expanduser(os.path.expandvars(path))
+
+
+def settings_path(override_config_file=None):
+    """
+    default looks for skytap.ini in the current working directory; can be over-ridden by $SKYTAP_INI env variable
+    config filename can be over-ridden with function argument (expected use: unit testing)
+    """
+    config_filename = "skytap.ini"
+    if override_config_file:
+        config_filename = override_config_file
+    skytap_default_ini_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), config_filename)
+    return expand_path(os.environ.get("SKYTAP_INI", skytap_default_ini_path))
+
+
+def fast_start_path():
+    """the fast-start record can't wait for skytap.ini to be parsed, so it lives under $SKYTAP_CACHE_PATH or the default"""
+    return os.path.join(expand_path(os.environ.get("SKYTAP_CACHE_PATH", DEFAULT_CACHE_PATH)), FAST_START_FILE)
+
+
+def fast_start_identity(override_config_file=None):
+    """what an inventory was built from: the settings file, its mtime, and the SKYTAP_* environment"""
+    ini_path = settings_path(override_config_file)
+    try:
+        ini_mtime = os.path.getmtime(ini_path)
+    except OSError:
+        ini_mtime = None
+    return {"ini": ini_path,
+            "ini_mtime": ini_mtime,
+            "env": sorted([var, value] for var, value in os.environ.items() if var.startswith("SKYTAP_"))}
+
+
+def fast_start_response(argv):
+    """
+    answer a plain --list/--host from the last inventory built with the same settings, while it 
+    is younger than cache_ttl. Only json/os are needed; None means take the full path.
+    """
+    if argv in ([], ["--list"]):
+        host = None
+    elif len(argv) == 2 and argv[0] == "--host":
+        host = argv[1]
+    else:
+        return None
+
+    try:
+        with open(fast_start_path(), "r") as record_fh:
+            record = json.load(record_fh)
+    except (IOError, OSError, ValueError):
+        return None
+    if record.get("expires", 0) < time.time() or record.get("identity") != fast_start_identity():
+        return None
+    output_format = record.get("output_format", u"compat")
+    if host is None:
+        return dump_json(record["inventory"], output_format)
+    return dump_json(record["inventory"][u"_meta"][u"hostvars"].get(host, {}), output_format)
+
+
+def tag_values(environment):
+    """tags of an environment; the API gives {"id": ..., "value": ...} objects"""
+    return [ tag.get("value") if isinstance(tag, dict) else tag for tag in environment.get("tags") or () ]
+
+
+#the parts of a VM the inventory reads: hosts, addresses, credentials and the attribute groups
+VM_FIELDS = ("id", "name", "runstate", "credentials", "interfaces")
+INTERFACE_FIELDS = ("hostname", "ip", "nat_addresses", "network_name", "network_subnet")
+
+
+def slim_vm(vm):
+    """a VM reduced to VM_FIELDS, and its interfaces to INTERFACE_FIELDS"""
+    slim = dict((field, vm[field]) for field in VM_FIELDS if field in vm)
+    slim["interfaces"] = [ dict((field, interface[field]) for field in INTERFACE_FIELDS if field in interface) 
+                            for interface in vm.get("interfaces") or () ]
+    return slim
+
+
+#groups every inventory has, which an environment's group must not overwrite
+RESERVED_GROUP_NAMES = (u"skytap_environment", u"_meta", u"all", u"ungrouped")
+
+
+def safe_group_name(name):
+    """ansible group names should be valid identifiers"""
+    import re
+    import six
+    return re.sub(r"[^A-Za-z0-9_]", "_", six.text_type(name))
+
+
+def write_file_atomic(path, text):
+    """write text to path; readers see either the old file or the new one, never a partial write"""
+    import tempfile
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as tmp_fh:
+            tmp_fh.write(text)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def write_json_atomic(path, data):
+    write_file_atomic(path, json.dumps(data))
+
+
+def json_encoder(output_format):
+    """
+    (encode, separators) for an output format: compat matches json.dumps byte for byte; compact 
+    drops the whitespace, and encodes with ujson when it is installed
+    """
+    if output_format == u"compat":
+        return json.dumps, (", ", ": ")
+    if output_format != u"compact":
+        raise ValueError("unknown output_format: %s" % output_format)
+    try:
+        import ujson
+        return (lambda value: ujson.dumps(value, escape_forward_slashes=False)), (",", ":")
+    except ImportError:
+        return (lambda value: json.dumps(value, separators=(",", ":"))), (",", ":")
+
+
+def iter_json(data, encode=json.dumps, separators=(", ", ": "), depth=3):
+    """
+    yield the JSON text for data in pieces: dicts down to depth levels (the inventory, its groups
+    and _meta, and hostvars) are written key by key, anything deeper is encoded whole
+    """
+    if depth <= 0 or not isinstance(data, dict):
+        yield encode(data)
+        return
+    item_separator, key_separator = separators
+    yield "{"
+    for index, (key, value) in enumerate(data.items()):
+        yield (item_separator if index else "") + json.dumps(key) + key_separator
+        for chunk in iter_json(value, encode, separators, depth - 1):
+            yield chunk
+    yield "}"
+
+
+def write_json(data, out, output_format=u"compat"):
+    """stream data as JSON to out, one host's vars at a time, rather than building the whole string first"""
+    encode, separators = json_encoder(output_format)
+    for chunk in iter_json(data, encode, separators):
+        out.write(chunk)
+
+
+def dump_json(data, output_format=u"compat"):
+    """data as a JSON string in output_format, the same text write_json streams"""
+    encode, separators = json_encoder(output_format)
+    return "".join(iter_json(data, encode, separators))
+
+
+class Metrics(object):
+    """
+    Wall time per stage and counters (requests, retries, bytes) for an inventory call. 
+    Safe to share between the threads fetching several environments; concurrent stages add up.
+    """
+    def __init__(self):
+        import threading
+        self.timings = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def stage(self, name):
+        """context manager timing the enclosed block as stage name"""
+        import contextlib
+        @contextlib.contextmanager
+        def timed():
+            start = time.time()
+            try:
+                yield
+            finally:
+                self.add_time(name, time.time() - start)
+        return timed()
+
+    def as_dict(self):
+        with self._lock:
+            return {"stage_seconds": dict(self.timings), "counters": dict(self.counters)}
+
+    def prometheus_text(self):
+        """node_exporter textfile collector format"""
+        metrics = self.as_dict()
+        lines = ["# HELP skytap_inventory_stage_seconds Wall time spent in each stage of the last inventory call",
+                 "# TYPE skytap_inventory_stage_seconds gauge"]
+        lines.extend('skytap_inventory_stage_seconds{stage="%s"} %f' % (stage, seconds) 
+                        for stage, seconds in sorted(metrics["stage_seconds"].items()))
+        for counter, value in sorted(metrics["counters"].items()):
+            lines.append("# TYPE skytap_inventory_%s gauge" % counter)
+            lines.append("skytap_inventory_%s %d" % (counter, value))
+        return "\n".join(lines) + "\n"
+
+
+def retry_policy(max_retries, backoff_factor, max_retry_after, deadline=None):
+    """
+    urllib3 Retry for the API: exponential backoff with full jitter, retries on throttling 
+    and server errors, honoring (up to max_retry_after seconds) a 429/503 Retry-After header.
+    deadline is a callable giving the time by which retrying must stop, or None for no limit; 
+    waits are cut short at it and no retry is started after it.
+    """
+    import random
+    from urllib3.exceptions import MaxRetryError, ResponseError
+    from urllib3.util.retry import Retry
+
+    def remaining():
+        until = deadline() if deadline is not None else None
+        return None if until is None else max(0, until - time.time())
+
+    def within_deadline(seconds):
+        left = remaining()
+        return seconds if left is None else min(seconds, left)
+
+    class JitteredRetry(Retry):
+        def get_backoff_time(self):
+            return within_deadline(random.uniform(0, super(JitteredRetry, self).get_backoff_time()))
+
+        def get_retry_after(self, response):
+            retry_after = super(JitteredRetry, self).get_retry_after(response)
+            return None if retry_after is None else within_deadline(min(retry_after, max_retry_after))
+
+        def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+            if remaining() == 0:
+                #treated like running out of retries: a failed response is handed back, an error raised
+                raise MaxRetryError(_pool, url, error or ResponseError("deadline for the inventory call exceeded"))
+            return super(JitteredRetry, self).increment(method, url, response, error, _pool, _stacktrace)
+
+    #the last response is handed back rather than raised, so _handle_response reports it
+    return JitteredRetry(total=max_retries, backoff_factor=backoff_factor, status_forcelist=(429, 500, 502, 503, 504),
+                         respect_retry_after_header=True, raise_on_status=False)
+
+
+class CircuitBreaker(object):
+    """
+    Persists consecutive API failures across invocations. After threshold failures the circuit 
+    opens for cooldown seconds, during which the API is not called; one attempt is let through 
+    after that, closing the circuit again if it succeeds.
+    """
+    def __init__(self, path, threshold, cooldown):
+        self.path = path
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def load(self):
+        try:
+            with open(self.path, "r") as state_fh:
+                return json.load(state_fh)
+        except (IOError, OSError, ValueError):
+            return {"failures": 0, "open_until": 0}
+
+    def allow(self):
+        return self.load()["open_until"] <= time.time()
+
+    def record_failure(self):
+        state = self.load()
+        state["failures"] += 1
+        if state["failures"] >= self.threshold:
+            state["open_until"] = time.time() + self.cooldown
+        write_json_atomic(self.path, state)
+
+    def record_success(self):
+        if self.load()["failures"]:
+            write_json_atomic(self.path, {"failures": 0, "open_until": 0})
+
+
+def process_alive(pid):
+    import errno
+    try:
+        os.kill(pid, 0)
+    except OSError as error:
+        return error.errno == errno.EPERM
+    return True
+
+
+class FileLock(object):
+    """
+    Cross-process lock: a file created with O_EXCL, holding the holder's pid and host. Waiters poll 
+    for up to timeout seconds, then give up and go ahead unlocked rather than hang. A lock whose 
+    holder has died (same host), or that is older than stale_after seconds, is broken.
+    """
+    def __init__(self, path, timeout, stale_after):
+        self.path = path
+        self.timeout = timeout
+        self.stale_after = stale_after
+        self.held = False
+
+    def __enter__(self):
+        import errno
+        import random
+        import socket
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError as error:
+                if error.errno != errno.EEXIST:
+                    raise
+                if self.break_if_stale():
+                    continue
+                if time.time() >= deadline:
+                    LOG.warning("gave up waiting for %s after %ss; going ahead without it", self.path, self.timeout)
+                    return self
+                time.sleep(random.uniform(0.05, 0.15))
+                continue
+            with os.fdopen(fd, "w") as lock_fh:
+                json.dump({"pid": os.getpid(), "host": socket.gethostname()}, lock_fh)
+            self.held = True
+            return self
+
+    def __exit__(self, *exc_info):
+        if self.held:
+            self.held = False
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def break_if_stale(self):
+        """remove the lock if its holder is gone; True if the lock may be retried straight away"""
+        import socket
+        try:
+            age = time.time() - os.path.getmtime(self.path)
+            with open(self.path, "r") as lock_fh:
+                contents = lock_fh.read()
+        except (IOError, OSError):
+            return True
+        try:
+            holder = json.loads(contents)
+        except ValueError:
+            #still being written
+            holder = {}
+        dead_holder = holder.get("host") == socket.gethostname() and not process_alive(holder.get("pid"))
+        if not dead_holder and age < self.stale_after:
+            return False
+        LOG.warning("breaking stale lock %s (%s)", self.path, contents)
+        try:
+            #only if it is still the lock judged stale, not one a faster waiter just took
+            with open(self.path, "r") as lock_fh:
+                if lock_fh.read() == contents:
+                    os.remove(self.path)
+        except (IOError, OSError):
+            pass
+        return True
+
+
+class ResponseDecodeError(ValueError):
+    """a Skytap API response that isn't the JSON it should be"""
+
 
 class Client(object):
     """
     REST API client class
     """
     def __init__(self, base_url, username, password, **kwargs):
-        """Initialize a client session"""
+        """Initialize a client session; pool_maxsize should cover the number of threads sharing it"""
+        import requests
+        from requests.adapters import HTTPAdapter
         self.session = requests.Session()
-        self.session.mount("http://", HTTPAdapter(max_retries=kwargs.get("max_retries", 5)))
-        self.session.mount("https://", HTTPAdapter(max_retries=kwargs.get("max_retries", 5)))
+        pool_maxsize = kwargs.get("pool_maxsize", 10)
+        retries = retry_policy(kwargs.get("max_retries", 5), kwargs.get("backoff_factor", 0.5), kwargs.get("max_retry_after", 60),
+                               deadline=lambda: self.deadline)
+        self.session.mount("http://", HTTPAdapter(max_retries=retries, pool_maxsize=pool_maxsize))
+        self.session.mount("https://", HTTPAdapter(max_retries=retries, pool_maxsize=pool_maxsize))
+        self.connect_timeout = kwargs.get("connect_timeout", Client.CONNECT_TIMEOUT)
+        self.read_timeout = kwargs.get("read_timeout", Client.REQUEST_TIMEOUT)
+        self.deadline = None
         self.session.auth = (username, password)
         self.session.verify = kwargs.get("ssl_cert_file", True)
         self.base_url = base_url
+        self.metrics = kwargs.get("metrics") or Metrics()
         self.session.headers.update({"Content-Type": "application/json", "Accept": "application/json", "User-Agent": "Skytap Ansible Inventory"})
 
     @staticmethod
     def construct_url(base_url, resource, **kwargs):
-        url_parts = (None, None, urljoin(base_url, resource), urlencode(kwargs), None)
+        from six.moves.urllib.parse import urlencode, urljoin, urlunsplit
+        url_parts = ("", "", urljoin(base_url, resource), urlencode(kwargs), "")
         return urlunsplit(url_parts)
 
     def _handle_response(self, response, resource):
+        import requests
         try:
             response.raise_for_status()
         except requests.HTTPError:
@@ -61,21 +445,355 @@ class Client(object):
             raise requests.HTTPError(response, result, resource)
 
     REQUEST_TIMEOUT = 90
+    CONNECT_TIMEOUT = 10
+
+    def start_deadline(self, seconds):
+        """bound every request from now on to finish within seconds overall (0: no deadline)"""
+        self.deadline = time.time() + seconds if seconds else None
+
+    def timeout(self):
+        """(connect, read) timeouts, shortened to whatever is left before the deadline"""
+        import requests
+        if self.deadline is None:
+            return (self.connect_timeout, self.read_timeout)
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise requests.Timeout("deadline for the inventory call exceeded")
+        return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+    def _record_response(self, response):
+        """count the request and any retries urllib3 made for it"""
+        self.metrics.count("requests")
+        retries = getattr(response.raw, "retries", None)
+        if retries is not None and retries.history:
+            self.metrics.count("retries", len(retries.history))
+
+    def get_response(self, resource, headers=None, **kwargs):
+        """Send a GET request, returning the response object (used for conditional requests)"""
+        url = self.construct_url(self.base_url, resource, **kwargs)
+        LOG.debug("%s", url)
+        with self.metrics.stage("http_request"):
+            response = self.session.get(url, headers=headers, timeout=self.timeout())
+        LOG.debug("result: [%s]", response)
+        self._record_response(response)
+        self.metrics.count("bytes_received", len(response.content))
+        self._handle_response(response, resource)
+        return response
+
+    def decode(self, response):
+        with self.metrics.stage("json_decode"):
+            try:
+                return response.json()
+            except ValueError as error:
+                raise ResponseDecodeError(error)
 
     def get(self, resource, **kwargs):
         """Send a GET request"""
+        return self.decode(self.get_response(resource, **kwargs)) 
+
+    @staticmethod
+    def total_items(response):
+        """total size of a paginated listing, from a 'Content-Range: items 0-99/1234' header"""
+        import re
+        match = re.search(r"/\s*(\d+)\s*$", response.headers.get("Content-Range", ""))
+        return int(match.group(1)) if match else None
+
+    def get_paginated(self, resource, page_size=100, max_workers=1, **kwargs):
+        """
+        GET every page of a listing. The first page gives the total size; the remaining pages 
+        are then fetched concurrently. Without a total, pages are walked until a short one.
+        """
+        first_page = self.get_response(resource, count=page_size, offset=0, **kwargs)
+        items = self.decode(first_page)
+        total = self.total_items(first_page)
+
+        if total is None:
+            page = items
+            while len(page) == page_size:
+                page = self.get(resource, count=page_size, offset=len(items), **kwargs)
+                items.extend(page)
+            return items
+
+        offsets = list(range(page_size, total, page_size))
+        if offsets:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(max(1, min(max_workers, len(offsets))))
+            try:
+                pages = pool.map(lambda offset: self.get(resource, count=page_size, offset=offset, **kwargs), offsets)
+            finally:
+                pool.close()
+                pool.join()
+            for page in pages:
+                items.extend(page)
+        return items
+
+    def get_stream(self, resource, **kwargs):
+        """Send a GET request, decoding the configuration document incrementally as it arrives"""
         url = self.construct_url(self.base_url, resource, **kwargs)
-        LOG.debug("%s", url)
-        response = self.session.get(url, timeout=Client.REQUEST_TIMEOUT)
+        LOG.debug("%s (streamed)", url)
+        #the body is read as it is decoded, so this times the request up to the response headers
+        with self.metrics.stage("http_request"):
+            response = self.session.get(url, stream=True, timeout=self.timeout())
         LOG.debug("result: [%s]", response)
+        self._record_response(response)
         self._handle_response(response, resource)
-        return response.json() 
+        return StreamedConfiguration(self._counted(response.iter_content(StreamedConfiguration.CHUNK_SIZE)))
+
+    def _counted(self, chunks):
+        for chunk in chunks:
+            self.metrics.count("bytes_received", len(chunk))
+            yield chunk
 
     def close(self):
         """Close the client session"""
         self.session.close()
         return True
 
+class StreamedConfiguration(object):
+    """
+    Incremental reader for a configuration document. VMs are decoded one at a time from the 
+    response stream, so memory follows the VM being parsed rather than the whole document. 
+    Other top level fields are kept as they go by; asking for one that comes after "vms" 
+    before the VMs have been consumed buffers the VMs.
+    """
+    CHUNK_SIZE = 65536
+
+    def __init__(self, chunks):
+        import codecs
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._decoder = json.JSONDecoder()
+        self._buffer = u""
+        self._pos = 0
+        self._eof = False
+        self._fields = {}
+        self._buffered_vms = None
+        self._vms_consumed = False
+
+        self._expect(u"{")
+        self._has_vms = self._read_members()
+
+    def _fill(self):
+        """append the next chunk to the buffer; False once the stream is exhausted"""
+        if self._pos > len(self._buffer) // 2:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        for chunk in self._chunks:
+            try:
+                text = self._utf8.decode(chunk)
+            except UnicodeDecodeError as error:
+                raise ResponseDecodeError(error)
+            if text:
+                self._buffer += text
+                return True
+        self._eof = True
+        return False
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in u" \t\r\n":
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ResponseDecodeError("Truncated configuration document")
+
+    def _expect(self, token):
+        if self._peek() != token:
+            raise ResponseDecodeError("Expected %r at offset %d of configuration document" % (token, self._pos))
+        self._pos += 1
+
+    def _decode_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+                #a number that ends the buffer may continue in the next chunk
+                if end < len(self._buffer) or self._eof:
+                    self._pos = end
+                    return value
+            except ValueError as error:
+                if self._eof:
+                    raise ResponseDecodeError(error)
+            if not self._fill() and self._pos >= len(self._buffer):
+                raise ResponseDecodeError("Truncated configuration document")
+
+    def _read_members(self):
+        """read top level members until the "vms" array (True, positioned at it) or the end of the document (False)"""
+        while True:
+            token = self._peek()
+            if token == u"}":
+                self._pos += 1
+                return False
+            if token == u",":
+                self._pos += 1
+                continue
+            key = self._decode_value()
+            self._expect(u":")
+            if key == u"vms":
+                return True
+            self._fields[key] = self._decode_value()
+
+    def _iter_vms(self):
+        self._vms_consumed = True
+        if not self._has_vms:
+            return
+        self._expect(u"[")
+        while True:
+            token = self._peek()
+            if token == u"]":
+                self._pos += 1
+                break
+            if token == u",":
+                self._pos += 1
+                continue
+            yield self._decode_value()
+        self._read_members()
+
+    def __getitem__(self, key):
+        if key == "vms":
+            if self._buffered_vms is not None:
+                return self._buffered_vms
+            if self._vms_consumed:
+                raise ValueError("VMs of a streamed configuration can only be iterated once")
+            return self._iter_vms()
+        if key not in self._fields and not self._vms_consumed:
+            self._buffered_vms = list(self._iter_vms())
+        return self._fields[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class HostRecord(object):
+    """
+    Addresses of one interface, gathered in a single pass over the configuration. 
+    credentials is shared by every record of the same VM. state holds the raw interface 
+    fields change detection fingerprints, and is only filled in when it is on.
+    """
+    __slots__ = ("hostname", "vm_id", "credentials", "private_ip", "icnr_ips", "vpn_ip", 
+                 "vm_name", "runstate", "network_name", "subnet", "state")
+
+    def __init__(self, hostname, vm_id, credentials):
+        self.hostname = hostname
+        self.vm_id = vm_id
+        self.credentials = credentials
+        self.private_ip = None
+        self.icnr_ips = ()
+        self.vpn_ip = None
+        self.vm_name = None
+        self.runstate = None
+        self.network_name = None
+        self.subnet = None
+        self.state = None
+
+    def addresses(self, network_type):
+        if network_type == "private":
+            return [self.private_ip] if self.private_ip is not None else []
+        if network_type == "nat_icnr":
+            return self.icnr_ips
+        if network_type == "nat_vpn":
+            return [self.vpn_ip] if self.vpn_ip is not None else []
+        return []
+
+
+class ResponseCache(object):
+    """
+    On-disk cache of API responses. Entries younger than ttl seconds are served as-is; 
+    older entries are revalidated with a conditional request (ETag / Last-Modified), so an 
+    unchanged resource costs a 304 instead of a full payload. With single_flight, concurrent 
+    processes missing the same entry queue on a lock file beside it: the first one fetches, and 
+    the others use what it stored.
+    """
+    def __init__(self, cache_path, ttl, single_flight=False, lock_timeout=120, lock_stale_after=300):
+        self.cache_path = expand_path(cache_path)
+        self.ttl = ttl
+        self.single_flight = single_flight
+        self.lock_timeout = lock_timeout
+        self.lock_stale_after = lock_stale_after
+
+    @staticmethod
+    def cache_key(*parts):
+        import hashlib
+        import six
+        return hashlib.sha1(u"|".join(six.text_type(part) for part in parts).encode("utf-8")).hexdigest()
+
+    def path_for(self, key, suffix="response"):
+        return os.path.join(self.cache_path, "%s.%s.json" % (key, suffix))
+
+    def load(self, key, suffix="response"):
+        try:
+            with open(self.path_for(key, suffix), "r") as cache_fh:
+                return json.load(cache_fh)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def store(self, key, entry, suffix="response"):
+        write_json_atomic(self.path_for(key, suffix), entry)
+
+    def is_fresh(self, entry):
+        return entry is not None and (time.time() - entry.get("timestamp", 0)) < self.ttl
+
+    def fetch(self, client, url, key, refresh=False):
+        """return the data for url, from the cache when fresh; refresh=True skips the cache entirely"""
+        requested = time.time()
+        entry = None if refresh else self.load(key)
+        if self.is_fresh(entry):
+            return entry["data"]
+        if not self.single_flight:
+            return self.revalidate(client, url, key, entry)
+
+        with FileLock(os.path.join(self.cache_path, "%s.lock" % key), self.lock_timeout, self.lock_stale_after):
+            #stored while we waited: that's the fetch we would have made
+            entry = self.load(key)
+            if entry is not None and entry.get("timestamp", 0) >= requested:
+                return entry["data"]
+            return self.revalidate(client, url, key, None if refresh else entry)
+
+    def produce(self, key, build, suffix, refresh=False):
+        """
+        like fetch, for data assembled from several requests, which can't be revalidated: build() 
+        when the entry under suffix is missing or stale, and store what it returns
+        """
+        requested = time.time()
+        entry = None if refresh else self.load(key, suffix)
+        if self.is_fresh(entry):
+            return entry["data"]
+        if not self.single_flight:
+            return self.store_built(key, build(), suffix)
+
+        with FileLock(os.path.join(self.cache_path, "%s.%s.lock" % (key, suffix)), self.lock_timeout, self.lock_stale_after):
+            entry = self.load(key, suffix)
+            if entry is not None and entry.get("timestamp", 0) >= requested:
+                return entry["data"]
+            return self.store_built(key, build(), suffix)
+
+    def store_built(self, key, data, suffix):
+        self.store(key, {"timestamp": time.time(), "data": data}, suffix=suffix)
+        return data
+
+    def revalidate(self, client, url, key, entry):
+        """fetch url, conditionally on the stale entry when there is one, and store the result"""
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = client.get_response(url, headers=headers)
+        if response.status_code != 304 or entry is None:
+            entry = {"etag": response.headers.get("ETag"),
+                     "last_modified": response.headers.get("Last-Modified"),
+                     "data": client.decode(response)}
+        entry["timestamp"] = time.time()
+        self.store(key, entry)
+        return entry["data"]
+
+
 class SkytapInventory(object):
 
     
@@ -87,6 +805,14 @@ class SkytapInventory(object):
     def network_types(self):
         return self._network_types 
 
+    @property
+    def group_rules(self):
+        return self._group_rules
+
+    @property
+    def group_rule_settings(self):
+        return self._group_rule_settings
+
     @property 
     def skytap_inventory_template(self): 
         return self._inventory_template
@@ -107,10 +833,38 @@ class SkytapInventory(object):
     def ansible_config_vars(self):
         return self._ansible_config_vars
 
+    @property
+    def skytap_runtime_vars(self):
+        return self._skytap_runtime_vars
 
-    def __init__(self, configuration_id=None, username=None, api_token=None, override_config_file=None, base_url=DEFAULT_BASE_URL):
+    @property
+    def response_cache(self):
+        return self._response_cache
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def circuit_breaker(self):
+        return self._circuit_breaker
+
+    @property
+    def environments(self):
+        """(group name, configuration_id) for every environment in the inventory"""
+        return self._environments
+
+
+    def __init__(self, configuration_id=None, username=None, api_token=None, override_config_file=None, base_url=DEFAULT_BASE_URL, refresh_cache=False, 
+                 changed_only=False, settings=None):
         """ Excecution path """
         self._ansible_config_vars =     {}
+        #[ansible_ssh_vars] connection tuning, emitted per host for the network types listed in tuned_network_types
+        self._ssh_tuning          =     {u"control_persist":None,
+                                            u"control_path":DEFAULT_CONTROL_PATH,
+                                            u"pipelining":None,
+                                            u"bastion":None,
+                                            u"tuned_network_types":u"nat_vpn,nat_icnr"}
         self._skytap_env_vars     =     {u"network_type":u"private",
                                          u"network_connection_id":None,
                                             u"configuration_id":configuration_id,
@@ -120,50 +874,156 @@ class SkytapInventory(object):
         self._skytap_vars         =     {u"base_url":base_url,
                                             u"username":username,
                                             u"api_token":api_token}
+        #defaults also fix the type each setting is coerced to after reading skytap.ini and the environment
+        self._runtime_var_defaults =    {u"cache_path":DEFAULT_CACHE_PATH,
+                                            u"cache_ttl":0,
+                                            u"max_workers":8,
+                                            u"stream_parse":False,
+                                            u"discover_name":None,
+                                            u"discover_tag":None,
+                                            u"discovery_cache_ttl":0,
+                                            u"page_size":100,
+                                            u"daemon_socket":DEFAULT_DAEMON_SOCKET,
+                                            u"daemon_interval":60,
+                                            u"daemon_max_backoff":600,
+                                            u"metrics":False,
+                                            u"metrics_textfile":None,
+                                            u"max_retries":5,
+                                            u"backoff_factor":0.5,
+                                            u"max_retry_after":60,
+                                            u"connect_timeout":10,
+                                            u"read_timeout":90,
+                                            u"deadline":0,
+                                            u"breaker_threshold":0,
+                                            u"breaker_cooldown":300,
+                                            u"enrich_resources":None,
+                                            u"enrich_cache_ttl":0,
+                                            u"output_format":u"compat",
+                                            u"hoist_hostvars":False,
+                                            u"change_detection":False,
+                                            u"probe":None,
+                                            u"probe_timeout":1.0,
+                                            u"probe_workers":64,
+                                            u"probe_cache_ttl":30,
+                                            u"single_flight":False,
+                                            u"lock_timeout":120,
+                                            u"lock_stale_after":300,
+                                            u"fetch_strategy":u"configuration"}
+        self._skytap_runtime_vars =     dict(self._runtime_var_defaults)
         self._empty_inventory     =     {u"_meta":{u"hostvars": {}}}
         self._inventory_template  =     {u"skytap_environment"  : {u"hosts": [], u"vars": {}},
                                             u"_meta": {u"hostvars":{}}}
         self._network_types        =     {"nat_vpn": self.build_vpn_ip_group, 
                                             "nat_icnr":self.build_icnr_ip_group,
                                             "private": self.build_private_ip_group}
+        #[skytap_groups] rules: group key for a host record (None for no group), given the rule's setting.
+        #"tag" is also a rule, but applies to the whole environment; see index_attribute_groups
+        self._group_rules          =     {u"name_prefix": lambda record, delimiter: (record.vm_name or u"").split(delimiter)[0],
+                                            u"runstate": lambda record, setting: record.runstate,
+                                            u"network_name": lambda record, setting: record.network_name,
+                                            u"subnet": lambda record, setting: record.subnet}
+        self._group_rule_settings =     {}
         self._clientData = {}
         self._inventory = self._inventory_template
+        self._environment_names = {}
+        self._environments = []
+        self._vm_hostnames = {}
+        self._vm_states = {}
+        self.refresh_cache = refresh_cache
+        self.changed_only = changed_only
+        #{section: {var: value}} in skytap.ini's layout, over-riding the file (used by the inventory plugin)
+        self._settings = settings or {}
+        #settings passed as arguments (or by the plugin) aren't part of the identity, so only a settings-file inventory gets a fast-start record
+        self._fast_start_identity = None
+        if configuration_id is None and username is None and api_token is None and not self._settings:
+            self._fast_start_identity = fast_start_identity(override_config_file)
 
-        self.read_settings(override_config_file)
+        self._metrics = Metrics()
+        with self.metrics.stage("config_read"):
+            self.read_settings(override_config_file)
         
         #over-ride settings from environment variables, if present 
-        for vars_dict in (self.skytap_env_vars, self.skytap_vars):
+        for vars_dict in (self.skytap_env_vars, self.skytap_vars, self.skytap_runtime_vars):
             for var in vars_dict:
                 if os.environ.get('SKYTAP_' + str(var).upper()):
                     vars_dict[var] = unicode(os.environ.get('SKYTAP_' + str(var).upper()))
+        self.coerce_runtime_vars()
+
+        #configuration_id may hold a comma separated list of environments; names come from [environments] when present
+        configuration_ids = unicode(self.skytap_env_vars[u"configuration_id"] or u"").split(u",")
+        self._environments = [ (self._environment_names.get(config_id.strip(), u"skytap_environment_" + config_id.strip()), config_id.strip())
+                                    for config_id in configuration_ids if config_id.strip() ]
+
+        self._response_cache = None
+        if self.skytap_runtime_vars[u"cache_ttl"] > 0 or self.skytap_runtime_vars[u"single_flight"]:
+            self._response_cache = ResponseCache(self.skytap_runtime_vars[u"cache_path"], self.skytap_runtime_vars[u"cache_ttl"],
+                                                 single_flight=self.skytap_runtime_vars[u"single_flight"],
+                                                 lock_timeout=self.skytap_runtime_vars[u"lock_timeout"],
+                                                 lock_stale_after=self.skytap_runtime_vars[u"lock_stale_after"])
+        self._enrichment_cache = None
+        if self.skytap_runtime_vars[u"enrich_cache_ttl"] > 0:
+            self._enrichment_cache = ResponseCache(self.skytap_runtime_vars[u"cache_path"], self.skytap_runtime_vars[u"enrich_cache_ttl"])
 
-        self._client = Client(self.skytap_vars[u"base_url"], self.skytap_vars[u"username"], self.skytap_vars[u"api_token"])
+        runtime_vars = self.skytap_runtime_vars
+        self._client = Client(self.skytap_vars[u"base_url"], self.skytap_vars[u"username"], self.skytap_vars[u"api_token"],
+                              pool_maxsize=runtime_vars[u"max_workers"], metrics=self.metrics,
+                              max_retries=runtime_vars[u"max_retries"], backoff_factor=runtime_vars[u"backoff_factor"],
+                              max_retry_after=runtime_vars[u"max_retry_after"],
+                              connect_timeout=runtime_vars[u"connect_timeout"], read_timeout=runtime_vars[u"read_timeout"])
+
+        self._circuit_breaker = None
+        if runtime_vars[u"breaker_threshold"] > 0:
+            self._circuit_breaker = CircuitBreaker(os.path.join(expand_path(runtime_vars[u"cache_path"]), "circuit.json"),
+                                                   runtime_vars[u"breaker_threshold"], runtime_vars[u"breaker_cooldown"])
+
+
+    def coerce_runtime_vars(self):
+        """ini files and environment variables only hold strings; convert runtime vars to the type of their defaults"""
+        import six
+        for var, default in self._runtime_var_defaults.items():
+            value = self.skytap_runtime_vars[var]
+            if not isinstance(value, six.string_types):
+                continue
+            #no booleans in ini; 'true' (or, for environment variables' sake, '1'/'yes') is true, everything else is false
+            if isinstance(default, bool):
+                value = (value.upper() in (u'TRUE', u'1', u'YES'))
+            elif isinstance(default, int):
+                value = int(value)
+            elif isinstance(default, float):
+                value = float(value)
+            self.skytap_runtime_vars[var] = value
 
 
     def read_settings(self, override_config_file=None): 
+        import six
+        from six.moves import configparser
         if six.PY2: 
             config = configparser.SafeConfigParser(allow_no_value=True)
         else: 
             config = configparser.ConfigParser(allow_no_value=True)
 
-        #default looks for skytap.ini in the current working directory; can be over-ridden by $SKYTAP_INI env variable
-        #config filename can be over-ridden with function argument (expected use: unit testing)
-        config_filename = "skytap.ini"
-        if override_config_file:
-            config_filename = override_config_file
-        skytap_default_ini_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), config_filename)
-        skytap_ini_path = os.path.expanduser(os.path.expandvars(os.environ.get("SKYTAP_INI", skytap_default_ini_path)))
-        config.read(skytap_ini_path)
+        config.read(settings_path(override_config_file))
  
         #config values are set as side effects in three places: skytap_vars, skytap_env_vars, and ansible_config_vars
         #tests should validate the state of these three objects.  
         #----
+        #an [environments] block of <group name>: <configuration_id> pairs stands in for configuration_id
+        if config.has_section("environments"):
+            environment_items = config.items("environments")
+            for name, config_id in environment_items:
+                self._environment_names[unicode(config_id).strip()] = safe_group_name(name)
+            if self.skytap_env_vars[u"configuration_id"] is None:
+                self.skytap_env_vars[u"configuration_id"] = u",".join(unicode(config_id).strip() for _, config_id in environment_items)
         #these are required args; "None" indicates no CLI args were present
         if self.skytap_vars[u"username"] is None:
             self.skytap_vars[u"username"] = unicode(config.get("skytap_vars", "username"))
         if self.skytap_vars[u"api_token"] is None:
             self.skytap_vars[u"api_token"] = unicode(config.get("skytap_vars", "api_token"))
-        if self.skytap_env_vars[u"configuration_id"] is None:
+        #environments may instead be discovered by name/tag, in which case configuration_id is optional
+        discovery_requested = any(config.has_option("skytap_runtime_vars", var) or os.environ.get("SKYTAP_" + var.upper())
+                                    or self._settings.get("skytap_runtime_vars", {}).get(var)
+                                    for var in ("discover_name", "discover_tag"))
+        if self.skytap_env_vars[u"configuration_id"] is None and not (discovery_requested and not config.has_option("skytap_env_vars", "configuration_id")):
             self.skytap_env_vars[u"configuration_id"] = unicode(config.get("skytap_env_vars", "configuration_id"))
         #defaults are set in __init__; config may over-ride 
         if config.has_option("skytap_env_vars", "network_type"):
@@ -193,17 +1053,89 @@ class SkytapInventory(object):
             self.ansible_config_vars[u"ansible_ssh_host"] = unicode(config.get("ansible_ssh_vars", "host"))
         if  config.has_option("ansible_ssh_vars", "private_key_file"):
             self.ansible_config_vars[u"ansible_ssh_private_key_file"] = unicode(config.get("ansible_ssh_vars", "private_key_file"))
+        #raw: ControlPath tokens such as %C are ssh's, not ConfigParser interpolation
+        for var in (u"control_persist", u"control_path", u"bastion", u"tuned_network_types"):
+            if config.has_option("ansible_ssh_vars", var):
+                self._ssh_tuning[var] = unicode(config.get("ansible_ssh_vars", var, raw=True)).strip()
+        if config.has_option("ansible_ssh_vars", "pipelining"):
+            self._ssh_tuning[u"pipelining"] = unicode(config.get("ansible_ssh_vars", "pipelining")).strip().upper() == u"TRUE"
+        #runtime vars tune how the inventory is fetched (caching etc.); types are coerced in __init__
+        for var in self.skytap_runtime_vars:
+            if config.has_option("skytap_runtime_vars", var):
+                self.skytap_runtime_vars[var] = unicode(config.get("skytap_runtime_vars", var))
+        #[skytap_groups] turns on extra groups built from VM attributes: "<rule>: true", or for name_prefix, the delimiter
+        if config.has_section("skytap_groups"):
+            for rule, setting in config.items("skytap_groups"):
+                setting = unicode(setting or u"true").strip()
+                if rule not in self.group_rules and rule != u"tag":
+                    LOG.warning("unknown [skytap_groups] rule %s ignored", rule)
+                elif setting.upper() == u"FALSE":
+                    continue
+                elif rule == u"name_prefix":
+                    self._group_rule_settings[rule] = u"-" if setting.upper() == u"TRUE" else setting
+                elif setting.upper() == u"TRUE":
+                    self._group_rule_settings[rule] = setting
+        #settings passed in directly win over the file
+        for section, vars_dict in (("skytap_vars", self.skytap_vars), ("skytap_env_vars", self.skytap_env_vars), 
+                                   ("skytap_runtime_vars", self.skytap_runtime_vars)):
+            for var, value in self._settings.get(section, {}).items():
+                if var in vars_dict and value is not None:
+                    vars_dict[var] = value
         #set ansible vars in inventory object
         self._inventory_template[u"skytap_environment"][u"vars"] = self._ansible_config_vars
 
 
-    def get_data(self):
-        query_string = RESOURCE_NAME + "/" + str(self.skytap_env_vars[u"configuration_id"]) + ".json"
+    def get_data(self, configuration_id=None):
+        if configuration_id is None:
+            configuration_id = self.skytap_env_vars[u"configuration_id"]
+        if self.skytap_runtime_vars[u"fetch_strategy"] == u"vms":
+            self._clientData = self.get_vm_data(configuration_id)
+            return self._clientData
+        query_string = RESOURCE_NAME + "/" + str(configuration_id) + ".json"
         url = Client.construct_url(self.skytap_vars[u"base_url"], query_string)
-        self._clientData = self._client.get(url)
+        if self.response_cache is None and self.skytap_runtime_vars[u"stream_parse"]:
+            self._clientData = self._client.get_stream(url)
+        elif self.response_cache is None:
+            self._clientData = self._client.get(url)
+        else:
+            cache_key = ResponseCache.cache_key(self.skytap_vars[u"base_url"], 
+                                                configuration_id, 
+                                                self.skytap_env_vars[u"network_type"])
+            self._clientData = self.response_cache.fetch(self._client, url, cache_key, refresh=self.refresh_cache)
         return self._clientData
     
 
+    def get_vm_data(self, configuration_id):
+        """
+        fetch_strategy:vms -- a configuration-shaped document built from the environment's VM listing, 
+        page_size VMs per request with pages fetched concurrently, each VM kept to VM_FIELDS. The tunnel 
+        (nat_icnr with a network_connection_id) and the tags (the tag group rule) are only fetched when 
+        used. With caching on, the document is reused for cache_ttl seconds, and single_flight shares 
+        one fetch of it between concurrent runs.
+        """
+        if self.response_cache is None:
+            return self.fetch_vm_data(configuration_id)
+        #the document holds the tunnel and tags only when they were asked for, so they are part of the key
+        cache_key = ResponseCache.cache_key(self.skytap_vars[u"base_url"], configuration_id, self.skytap_env_vars[u"network_type"], 
+                                            self.skytap_env_vars[u"network_connection_id"], u"tag" in self.group_rule_settings)
+        return self.response_cache.produce(cache_key, lambda: self.fetch_vm_data(configuration_id), "vms", refresh=self.refresh_cache)
+
+
+    def fetch_vm_data(self, configuration_id):
+        """the fetch_strategy:vms document, from the API"""
+        base_url = self.skytap_vars[u"base_url"]
+        url = Client.construct_url(base_url, "%s/%s/vms.json" % (RESOURCE_NAME, configuration_id))
+        vms = self._client.get_paginated(url, self.skytap_runtime_vars[u"page_size"], self.skytap_runtime_vars[u"max_workers"])
+        data = {"id": unicode(configuration_id), "vms": [ slim_vm(vm) for vm in vms ]}
+
+        connection_id = self.skytap_env_vars[u"network_connection_id"]
+        if connection_id and u"nat_icnr" in self.requested_network_types():
+            data["tunnels"] = [self._client.get(Client.construct_url(base_url, "tunnels/%s.json" % connection_id))]
+        if u"tag" in self.group_rule_settings:
+            data["tags"] = self._client.get(Client.construct_url(base_url, "%s/%s/tags.json" % (RESOURCE_NAME, configuration_id)))
+        return data
+
+
     #add user/pass data to the individual hosts in the inventory if the necessary data is present in both skytap.ini nd the API response
     #this is set for VM's, not for interfaces -- so each of the network parser types will use this method the same way
     #NOTE: this parses a free-form field; it expects a <user_token> <delimiter_token> <password_token> format; 
@@ -218,12 +1150,12 @@ class SkytapInventory(object):
         l_uname = self.skytap_env_vars[u'skytap_vm_username']
 
         #if there is a single credential pair and username is unset, use the pair available
-        if (len(vm_data['credentials']) is 1) and (l_uname is None):
+        if (len(vm_data['credentials']) == 1) and (l_uname is None):
             selected_creds = vm_data['credentials']
         else: 
             #credentials object is a list of dictionaries; each dictionary contains a field called 'text'.  We're interested in 
             #the first token of the 'text' field when the field is split on some delimeter (e.g., {'text': 'username / password'})
-            selected_creds = filter(lambda cred_obj:cred_obj['text'].split(l_delim)[0].strip() == l_uname, vm_data['credentials'])
+            selected_creds = [ cred_obj for cred_obj in vm_data['credentials'] if cred_obj['text'].split(l_delim)[0].strip() == l_uname ]
         
         if len(selected_creds) < 1: return user_pass #no match; return empty dict
         else: selected_creds = selected_creds[0]['text']
@@ -234,76 +1166,888 @@ class SkytapInventory(object):
         return user_pass 
 
 
-    def build_private_ip_group(self, client_data, inventory):
-        for vm in client_data["vms"]:
-            creds_dict = self.parse_credentials_for_vm(vm)
-            for interface in vm["interfaces"]: 
-                if (interface.has_key("ip")) and (interface["ip"] is not None):
-                    hostname = unicode(interface["hostname"])
-                    inventory[u"skytap_environment"][u"hosts"].append(hostname)
-                    inventory[u"_meta"][u"hostvars"][hostname] = {u"ansible_ssh_host":unicode(interface["ip"])}
-                    inventory[u'_meta'][u'hostvars'][hostname].update(creds_dict)
+    def add_hosts(self, inventory, hosts):
+        """add (hostname, hostvars) pairs to the inventory as they are produced"""
+        for hostname, hostvars in hosts:
+            inventory[u"skytap_environment"][u"hosts"].append(hostname)
+            inventory[u"_meta"][u"hostvars"][hostname] = hostvars
         return inventory
 
 
-    def build_icnr_ip_group(self, client_data, inventory): 
-        """update the inventory file to include a group for the ICNR IP addresses"""
+    def requested_network_types(self):
+        """network_type may name several types, comma separated; each becomes its own group"""
+        return [ network_type.strip() for network_type in unicode(self.skytap_env_vars[u"network_type"]).split(u",") 
+                    if network_type.strip() ]
+
+
+    def extract_hosts(self, client_data, network_types):
+        """
+        walk the configuration once, yielding a HostRecord per interface with the addresses 
+        for each of the requested network types
+        """
+        connection_id = self.skytap_env_vars["network_connection_id"]
+        want_private = "private" in network_types
+        want_icnr = "nat_icnr" in network_types
+        want_vpn = "nat_vpn" in network_types
+        want_state = self.change_detection()
 
         tunnel_source_network = None
-        if self.skytap_env_vars["network_connection_id"]:
-            matching_tunnels = [ tunnel for tunnel in client_data["tunnels"] if tunnel["id"] == self.skytap_env_vars["network_connection_id"] ]
+        if want_icnr and connection_id:
+            matching_tunnels = [ tunnel for tunnel in client_data["tunnels"] if tunnel["id"] == connection_id ]
             if not matching_tunnels:
-                raise Exception("No tunnels with id %s found" % self.skytap_env_vars["network_connection_id"])
+                raise Exception("No tunnels with id %s found" % connection_id)
 
             tunnel_source_network = matching_tunnels[0]["source_network"]["url"]
 
-        for vm in client_data["vms"]: 
+        for vm in client_data["vms"]:
+            #one credentials dict per VM, shared by all of its interfaces
             creds_dict = self.parse_credentials_for_vm(vm)
             for interface in vm["interfaces"]:
-                if (interface.has_key("nat_addresses")) and (interface["nat_addresses"].has_key("network_nat_addresses")):  
-                    for network_nat in interface["nat_addresses"]["network_nat_addresses"]:
-                        if tunnel_source_network and network_nat["network_url"] != tunnel_source_network:
+                record = HostRecord(unicode(interface["hostname"]), vm.get("id"), creds_dict)
+                record.vm_name = vm.get("name")
+                record.runstate = vm.get("runstate")
+                record.network_name = interface.get("network_name")
+                record.subnet = interface.get("network_subnet")
+                if want_state:
+                    record.state = [interface.get("hostname"), interface.get("ip"), interface.get("nat_addresses"), 
+                                    vm.get("credentials"), vm.get("runstate")]
+                if want_private and interface.get("ip") is not None:
+                    record.private_ip = unicode(interface["ip"])
+
+                nat_addresses = interface.get("nat_addresses") or {}
+                if want_icnr:
+                    record.icnr_ips = [ unicode(network_nat["ip_address"]) for network_nat in nat_addresses.get("network_nat_addresses", ())
+                                            if not tunnel_source_network or network_nat["network_url"] == tunnel_source_network ]
+                if want_vpn:
+                    for vpn_nat in nat_addresses.get("vpn_nat_addresses", ()):
+                        if connection_id and connection_id != vpn_nat["vpn_id"]:
                             continue
-                        hostname = unicode(interface["hostname"])
-                        inventory[u"skytap_environment"][u"hosts"].append(hostname)
-                        inventory[u"_meta"][u"hostvars"][hostname] = {u"ansible_ssh_host":unicode(network_nat["ip_address"])} 
-                        inventory[u'_meta'][u'hostvars'][hostname].update(creds_dict)
+                        # just hostname/nat_vpn per interface
+                        record.vpn_ip = unicode(vpn_nat["ip_address"])
+                        break
+                yield record
+
+
+    def iter_hosts(self, records, network_type):
+        """yield (hostname, hostvars) for every address of network_type; hostvars are only built here"""
+        for record in records:
+            for address in record.addresses(network_type):
+                hostvars = dict(record.credentials)
+                hostvars[u"ansible_ssh_host"] = address
+                yield record.hostname, hostvars
+
+
+    def index_attribute_groups(self, records, client_data, inventory):
+        """
+        pass records through, indexing each under the [skytap_groups] rules as it goes by; once 
+        they are exhausted, add a group per indexed value for the hosts that made it into the 
+        inventory. The rules ride along on the extraction pass instead of each scanning the hosts.
+        """
+        index = {}
+        hostnames = []
+        record_rules = [ (rule, setting, self.group_rules[rule]) for rule, setting in self.group_rule_settings.items() 
+                            if rule in self.group_rules ]
+        for record in records:
+            for rule, setting, group_key in record_rules:
+                key = group_key(record, setting)
+                if key:
+                    index.setdefault(u"skytap_%s_%s" % (rule, safe_group_name(key)), []).append(record.hostname)
+            if u"tag" in self.group_rule_settings:
+                hostnames.append(record.hostname)
+            yield record
+
+        #environment tags apply to every host, so they are looked up once rather than per record
+        if u"tag" in self.group_rule_settings:
+            for tag in tag_values(client_data):
+                index.setdefault(u"skytap_tag_" + safe_group_name(tag), []).extend(hostnames)
+
+        hostvars = inventory[u"_meta"][u"hostvars"]
+        for group_name, members in index.items():
+            seen = set()
+            members = [ hostname for hostname in members if hostname in hostvars and not (hostname in seen or seen.add(hostname)) ]
+            if members:
+                inventory.setdefault(group_name, {u"hosts": [], u"vars": {}})[u"hosts"].extend(members)
+
+
+    def host_records(self, client_data, inventory, network_types):
+        records = self.extract_hosts(client_data, network_types)
+        if self.group_rule_settings:
+            records = self.index_attribute_groups(records, client_data, inventory)
+        if self.enrich_resources() or self.change_detection():
+            records = self.track_vms(records)
+        return records
+
+
+    def track_vms(self, records):
+        """remember which hostnames belong to which VM, and what they looked like, for the enrichment and change detection stages"""
+        for record in records:
+            self._vm_hostnames.setdefault(record.vm_id, []).append(record.hostname)
+            if record.state is not None:
+                self._vm_states.setdefault(record.vm_id, []).append(record.state)
+            yield record
+
+
+    def change_detection(self):
+        return self.changed_only or self.skytap_runtime_vars[u"change_detection"]
+
+
+    def vm_fingerprints(self):
+        """vm id -> hash of its interfaces, addresses (private and NAT), credentials and runstate"""
+        import hashlib
+        return dict( (vm_id, hashlib.sha1(json.dumps(states, sort_keys=True).encode("utf-8")).hexdigest()) 
+                        for vm_id, states in self._vm_states.items() )
+
+
+    def mark_changed_hosts(self, inventory):
+        """
+        the skytap_changed group: hosts of VMs that are new, or whose fingerprint differs from the
+        one saved by the previous run. The fingerprints saved now are what the next run compares to; 
+        only VMs still in the inventory (e.g. not dropped by probe:filter) are saved.
+        """
+        fingerprint_cache = ResponseCache(self.skytap_runtime_vars[u"cache_path"], 0)
+        previous = (fingerprint_cache.load(self.inventory_cache_key(), suffix="fingerprints") or {}).get("fingerprints", {})
+        present = inventory[u"_meta"][u"hostvars"]
+        fingerprints = dict( (vm_id, fingerprint) for vm_id, fingerprint in self.vm_fingerprints().items() 
+                                if any(hostname in present for hostname in self._vm_hostnames[vm_id]) )
+        changed = set()
+        for vm_id, fingerprint in fingerprints.items():
+            if previous.get(vm_id) != fingerprint:
+                changed.update(self._vm_hostnames[vm_id])
+
+        hostnames = []
+        for hostname in inventory[u"skytap_environment"][u"hosts"]:
+            if hostname in changed and hostname not in hostnames:
+                hostnames.append(hostname)
+        inventory[u"skytap_changed"] = {u"hosts": hostnames, u"vars": {}}
+        fingerprint_cache.store(self.inventory_cache_key(), {"fingerprints": fingerprints}, suffix="fingerprints")
+        return inventory
+
+
+    def only_changed_hosts(self, inventory):
+        """a copy of the inventory holding just the hosts in skytap_changed"""
+        changed = set(inventory.get(u"skytap_changed", {}).get(u"hosts", []))
+        result = dict( (group_name, {u"hosts": [ hostname for hostname in group[u"hosts"] if hostname in changed ], 
+                                     u"vars": group[u"vars"]}) 
+                        for group_name, group in inventory.items() if group_name != u"_meta" )
+        result[u"_meta"] = {u"hostvars": dict( (hostname, hostvars) for hostname, hostvars in inventory[u"_meta"][u"hostvars"].items() 
+                                                if hostname in changed )}
+        return result
+
+
+    def enrich_resources(self):
+        """per-VM sub-resources (e.g. user_data) to merge into hostvars as skytap_<resource>"""
+        return [ resource.strip() for resource in unicode(self.skytap_runtime_vars[u"enrich_resources"] or u"").split(u",") 
+                    if resource.strip() ]
+
+
+    def fetch_enrichment(self, vm_id, resource):
+        """vms/<vm_id>/<resource>.json, revalidated by ETag/Last-Modified once its cache entry is stale; None if the VM has none"""
+        import requests
+        url = Client.construct_url(self.skytap_vars[u"base_url"], "vms/%s/%s.json" % (vm_id, resource))
+        try:
+            if self._enrichment_cache is None:
+                return self._client.get(url)
+            cache_key = ResponseCache.cache_key(self.skytap_vars[u"base_url"], vm_id, resource)
+            return self._enrichment_cache.fetch(self._client, url, cache_key, refresh=self.refresh_cache)
+        except requests.HTTPError as error:
+            LOG.debug("no %s for VM %s: %s", resource, vm_id, error)
+            return None
+        except requests.RequestException as error:
+            #an optional sub-resource: the VM stays in the inventory, just without it
+            LOG.warning("could not fetch %s for VM %s: %s", resource, vm_id, error)
+            return None
+
+
+    def enrich_hostvars(self, inventory):
+        """fetch every VM's sub-resources concurrently on a bounded pool, and merge them into that VM's hostvars"""
+        from multiprocessing.pool import ThreadPool
+        fetches = [ (vm_id, resource) for vm_id in self._vm_hostnames for resource in self.enrich_resources() ]
+        if not fetches:
+            return inventory
+        pool = ThreadPool(max(1, min(self.skytap_runtime_vars[u"max_workers"], len(fetches))))
+        try:
+            results = pool.map(lambda fetch: self.fetch_enrichment(*fetch), fetches)
+        finally:
+            pool.close()
+            pool.join()
+
+        hostvars = inventory[u"_meta"][u"hostvars"]
+        for (vm_id, resource), result in zip(fetches, results):
+            if result is None:
+                continue
+            for hostname in self._vm_hostnames[vm_id]:
+                if hostname in hostvars:
+                    hostvars[hostname][u"skytap_" + resource] = result
         return inventory
 
 
+    def build_private_ip_group(self, client_data, inventory):
+        return self.add_hosts(inventory, self.iter_hosts(self.host_records(client_data, inventory, ("private",)), "private"))
+
+
+    def build_icnr_ip_group(self, client_data, inventory): 
+        """update the inventory file to include a group for the ICNR IP addresses"""
+        return self.add_hosts(inventory, self.iter_hosts(self.host_records(client_data, inventory, ("nat_icnr",)), "nat_icnr"))
+
+
     def build_vpn_ip_group(self, client_data, inventory): 
         """update the inventory file to include a group for the VPN IP addresees"""
-        for vm in client_data["vms"]:
-            creds_dict = self.parse_credentials_for_vm(vm)
-            for interface in vm["interfaces"]:
-                if (interface.has_key("nat_addresses")) and (interface["nat_addresses"].has_key("vpn_nat_addresses")):
-                    for vpn_nat in interface["nat_addresses"]["vpn_nat_addresses"]:
-                        if self.skytap_env_vars["network_connection_id"] and self.skytap_env_vars["network_connection_id"] != vpn_nat["vpn_id"]:
-                            continue
-                        hostname = unicode(interface["hostname"])
-                        inventory[u"skytap_environment"][u"hosts"].append(hostname)
-                        inventory[u'_meta'][u"hostvars"][hostname] = {u"ansible_ssh_host":unicode(vpn_nat["ip_address"])}
-                        inventory[u'_meta'][u'hostvars'][hostname].update(creds_dict)
-                        
-                        # just hostname/nat_vpn per interface
-                        break
+        return self.add_hosts(inventory, self.iter_hosts(self.host_records(client_data, inventory, ("nat_vpn",)), "nat_vpn"))
+
+
+    def build_network_type_groups(self, client_data, inventory, network_types):
+        """
+        one pass over client_data for several network types: a skytap_<network_type> group each. 
+        ansible_ssh_host comes from the first listed type the host has an address for; every 
+        address is also available as skytap_<network_type>_ip
+        """
+        for network_type in network_types:
+            inventory.setdefault(u"skytap_" + network_type, {u"hosts": [], u"vars": {}})
+
+        for record in self.host_records(client_data, inventory, network_types):
+            for network_type in network_types:
+                addresses = record.addresses(network_type)
+                if not addresses:
+                    continue
+                hostvars = inventory[u"_meta"][u"hostvars"].get(record.hostname)
+                if hostvars is None:
+                    hostvars = dict(record.credentials)
+                    hostvars[u"ansible_ssh_host"] = addresses[-1]
+                    inventory[u"_meta"][u"hostvars"][record.hostname] = hostvars
+                    inventory[u"skytap_environment"][u"hosts"].append(record.hostname)
+                hostvars[u"skytap_%s_ip" % network_type] = addresses[-1]
+                inventory[u"skytap_" + network_type][u"hosts"].append(record.hostname)
         return inventory
 
+    def get_all_data(self):
+        """fetch every environment concurrently on a bounded thread pool sharing the client's session"""
+        from multiprocessing.pool import ThreadPool
+        configuration_ids = [ config_id for _, config_id in self.environments ]
+        pool = ThreadPool(max(1, min(self.skytap_runtime_vars[u"max_workers"], len(configuration_ids))))
+        try:
+            return pool.map(self.get_data, configuration_ids)
+        finally:
+            pool.close()
+            pool.join()
+
+
+    def reset_inventory(self):
+        """start a new, empty inventory (a long lived instance rebuilds it on every refresh)"""
+        self._inventory = {u"skytap_environment": {u"hosts": [], u"vars": self._ansible_config_vars},
+                           u"_meta": {u"hostvars": {}}}
+        self._vm_hostnames = {}
+        self._vm_states = {}
+        return self._inventory
+
+
+    def inventory_cache_key(self):
+        return ResponseCache.cache_key(self.skytap_vars[u"base_url"], 
+                                       self.skytap_env_vars[u"configuration_id"], 
+                                       self.skytap_env_vars[u"network_type"],
+                                       self.skytap_runtime_vars[u"discover_name"],
+                                       self.skytap_runtime_vars[u"discover_tag"])
+
+
+    def discovery_configured(self):
+        return bool(self.skytap_runtime_vars[u"discover_name"] or self.skytap_runtime_vars[u"discover_tag"])
+
+
+    def matches_discovery(self, environment):
+        """client side filter for a configurations listing entry; the API's name query is only a pre-filter"""
+        import fnmatch
+        name_pattern = self.skytap_runtime_vars[u"discover_name"]
+        tag = self.skytap_runtime_vars[u"discover_tag"]
+        if name_pattern and not fnmatch.fnmatchcase(environment.get("name") or u"", name_pattern):
+            return False
+        if tag and tag not in tag_values(environment):
+            return False
+        return True
+
+
+    def discover_environments(self):
+        """(group name, configuration_id) for every environment matching discover_name / discover_tag"""
+        name_pattern = self.skytap_runtime_vars[u"discover_name"]
+        discovery_cache = None
+        if self.skytap_runtime_vars[u"discovery_cache_ttl"] > 0:
+            discovery_cache = ResponseCache(self.skytap_runtime_vars[u"cache_path"], self.skytap_runtime_vars[u"discovery_cache_ttl"])
+            cache_key = ResponseCache.cache_key(self.skytap_vars[u"base_url"], name_pattern, self.skytap_runtime_vars[u"discover_tag"])
+            entry = None if self.refresh_cache else discovery_cache.load(cache_key, suffix="discovery")
+            if discovery_cache.is_fresh(entry):
+                return [ tuple(environment) for environment in entry["environments"] ]
+
+        #let the API narrow the listing when the name is a literal rather than a pattern
+        query = {}
+        if name_pattern and not any(char in name_pattern for char in u"*?["):
+            query["query"] = u"name:" + name_pattern
+        url = Client.construct_url(self.skytap_vars[u"base_url"], RESOURCE_NAME + ".json")
+        listing = self._client.get_paginated(url, self.skytap_runtime_vars[u"page_size"], self.skytap_runtime_vars[u"max_workers"], **query)
+
+        environments = []
+        for environment in listing:
+            if not self.matches_discovery(environment):
+                continue
+            group_name = safe_group_name(environment.get("name") or environment["id"])
+            #names come from the API, so a reserved one is renamed rather than failing the inventory
+            if group_name in RESERVED_GROUP_NAMES:
+                LOG.warning("environment %s is named %s, a reserved group; using skytap_environment_%s", 
+                            environment["id"], group_name, environment["id"])
+                group_name = u"skytap_environment_" + unicode(environment["id"])
+            environments.append((group_name, unicode(environment["id"])))
+        if discovery_cache is not None:
+            discovery_cache.store(cache_key, {"timestamp": time.time(), "environments": environments}, suffix="discovery")
+        return environments
+
+
+    def store_host_index(self, inventory):
+        """persist the hostname -> hostvars index of the inventory just built, so --host needs no API call"""
+        if self.response_cache is not None:
+            self.response_cache.store(self.inventory_cache_key(), 
+                                      {"timestamp": time.time(), "hostvars": inventory[u"_meta"][u"hostvars"]}, 
+                                      suffix="hostvars")
+
+
+    def get_host(self, hostname):
+        """hostvars for a single host; answered from the persisted index while it is fresh"""
+        if self.response_cache is not None and not self.refresh_cache:
+            entry = self.response_cache.load(self.inventory_cache_key(), suffix="hostvars")
+            if self.response_cache.is_fresh(entry):
+                return entry["hostvars"].get(hostname, {})
+        return self.get_inventory()[u"_meta"][u"hostvars"].get(hostname, {})
+
+
     def get_inventory(self):
         """get the API data, parse it into an inventory"""
-        api_data = self.get_data() 
-        network_type = self.skytap_env_vars[u"network_type"]
-        parse_method = self.network_types[str(network_type)] 
-        parse_method(api_data, self.inventory)
+        import requests
+        breaker = self.circuit_breaker
+        if breaker is not None and not breaker.allow():
+            return self.last_good_inventory("the Skytap API circuit breaker is open")
+
+        self._client.start_deadline(self.skytap_runtime_vars[u"deadline"])
+        try:
+            with self.metrics.stage("get_inventory"):
+                self.build_inventory()
+        except (requests.RequestException, ResponseDecodeError) as error:
+            if breaker is None:
+                raise
+            breaker.record_failure()
+            return self.last_good_inventory(error)
 
+        if breaker is not None:
+            breaker.record_success()
+            write_json_atomic(self.last_good_path(), self.inventory)
+        self.store_host_index(self.inventory)
+        self.store_fast_start(self.inventory)
         return self.inventory
 
+
+    def last_good_path(self):
+        return os.path.join(expand_path(self.skytap_runtime_vars[u"cache_path"]), 
+                            "%s.last-good.json" % self.inventory_cache_key())
+
+
+    def last_good_inventory(self, reason):
+        """fall back to the last inventory built successfully, warning on stderr; re-raise without one"""
+        try:
+            with open(self.last_good_path(), "r") as inventory_fh:
+                self._inventory = json.load(inventory_fh)
+        except (IOError, OSError, ValueError):
+            if isinstance(reason, Exception):
+                raise reason
+            raise RuntimeError("%s and no previous inventory is cached" % reason)
+        sys.stderr.write("WARNING: serving the last good Skytap inventory: %s\n" % reason)
+        return self._inventory
+
+
+    def store_fast_start(self, inventory):
+        """record the inventory so the next invocation can print it without parsing settings or importing requests"""
+        if self.response_cache is not None and self._fast_start_identity is not None:
+            ttl = self.skytap_runtime_vars[u"cache_ttl"]
+            if self.probe_mode():
+                #the reachability groups (or the hosts probe:filter dropped) go stale with the probe results
+                ttl = min(ttl, self.skytap_runtime_vars[u"probe_cache_ttl"])
+            try:
+                write_json_atomic(fast_start_path(), {"identity": self._fast_start_identity,
+                                                      "output_format": self.skytap_runtime_vars[u"output_format"],
+                                                      "expires": time.time() + ttl,
+                                                      "inventory": inventory})
+            except (IOError, OSError) as error:
+                #only an optimisation; the inventory was built and is still printed
+                LOG.warning("could not record the inventory for fast start in %s: %s", fast_start_path(), error)
+
+
+    def build_inventory(self):
+        """build the hosts and groups for every environment, then run the optional post-processing stages"""
+        self.build_environments()
+        ssh_tuning = self.ssh_tuning_vars()
+        if ssh_tuning:
+            with self.metrics.stage("ssh_tuning"):
+                self.tune_ssh_connections(self.inventory, ssh_tuning)
+        if self.enrich_resources():
+            with self.metrics.stage("enrich"):
+                self.enrich_hostvars(self.inventory)
+        if self.probe_mode():
+            with self.metrics.stage("probe"):
+                self.probe_hosts(self.inventory)
+        if self.change_detection():
+            with self.metrics.stage("change_detection"):
+                self.mark_changed_hosts(self.inventory)
+        if self.skytap_runtime_vars[u"hoist_hostvars"]:
+            with self.metrics.stage("hoist"):
+                self.hoist_shared_hostvars(self.inventory)
+        return self.inventory
+
+
+    def ssh_tuning_vars(self):
+        """
+        the hostvars [ansible_ssh_vars] asks for on tuned hosts: ansible_ssh_common_args multiplexing 
+        connections over a ControlMaster socket (control_persist) and/or jumping through a bastion, 
+        and ansible_pipelining. Empty when none of them is set.
+        """
+        tuning = self._ssh_tuning
+        args = []
+        if tuning[u"control_persist"] and tuning[u"control_persist"].lower() not in (u"0", u"false", u"no"):
+            args.extend([u"-o ControlMaster=auto", u"-o ControlPersist=%s" % tuning[u"control_persist"],
+                         u"-o ControlPath=%s" % tuning[u"control_path"]])
+        if tuning[u"bastion"]:
+            args.append(u"-o ProxyJump=%s" % tuning[u"bastion"])
+        hostvars = {}
+        if args:
+            hostvars[u"ansible_ssh_common_args"] = u" ".join(args)
+        if tuning[u"pipelining"] is not None:
+            hostvars[u"ansible_pipelining"] = tuning[u"pipelining"]
+        return hostvars
+
+
+    def tune_ssh_connections(self, inventory, ssh_tuning):
+        """
+        add ssh_tuning to the hosts Ansible reaches over one of tuned_network_types. With several 
+        network types, that is the first listed type the host has an address for.
+        """
+        tuned = set(network_type.strip() for network_type in self._ssh_tuning[u"tuned_network_types"].split(u","))
+        network_types = self.requested_network_types()
+        for hostvars in inventory[u"_meta"][u"hostvars"].values():
+            if len(network_types) == 1:
+                connection_type = network_types[0]
+            else:
+                connection_type = next((network_type for network_type in network_types 
+                                            if u"skytap_%s_ip" % network_type in hostvars), None)
+            if connection_type in tuned:
+                hostvars.update(ssh_tuning)
+        return inventory
+
+
+    def ssh_address(self, inventory, hostname):
+        """(host, port) Ansible will connect to: the host's ansible_ssh_host/port, else skytap_environment's, else port 22"""
+        hostvars = inventory[u"_meta"][u"hostvars"].get(hostname, {})
+        group_vars = inventory[u"skytap_environment"][u"vars"]
+        port = hostvars.get(u"ansible_ssh_port", group_vars.get(u"ansible_ssh_port", 22))
+        return hostvars.get(u"ansible_ssh_host", group_vars.get(u"ansible_ssh_host", hostname)), int(port)
+
+
+    def behind_jump_host(self, inventory, hostname):
+        """whether Ansible reaches the host through a ProxyJump/ProxyCommand rather than connecting to it directly"""
+        hostvars = inventory[u"_meta"][u"hostvars"].get(hostname, {})
+        group_vars = inventory[u"skytap_environment"][u"vars"]
+        ssh_args = unicode(hostvars.get(u"ansible_ssh_common_args", group_vars.get(u"ansible_ssh_common_args", u"")))
+        return u"ProxyJump" in ssh_args or u"ProxyCommand" in ssh_args
+
+
+    def probe_mode(self):
+        """group, filter, or None when probing is off"""
+        mode = unicode(self.skytap_runtime_vars[u"probe"] or u"").strip().lower()
+        return None if mode in (u"", u"false", u"off") else mode
+
+
+    def probe_hosts(self, inventory):
+        """
+        TCP connect to every host's SSH address concurrently, each bounded by probe_timeout. probe:group 
+        sorts the hosts into skytap_reachable/skytap_unreachable; probe:filter drops the unreachable 
+        ones. Results are kept for probe_cache_ttl seconds, so back-to-back runs don't probe again. 
+        Hosts reached through a jump host (a bastion) can't be probed from here; they are left out of 
+        both groups, and never dropped.
+        """
+        import socket
+        from multiprocessing.pool import ThreadPool
+        runtime_vars = self.skytap_runtime_vars
+        mode = self.probe_mode()
+        if mode not in (u"group", u"filter"):
+            raise ValueError("unknown probe mode: %s" % mode)
+
+        probe_cache = ResponseCache(runtime_vars[u"cache_path"], runtime_vars[u"probe_cache_ttl"])
+        cache_key = self.inventory_cache_key()
+        entry = None if self.refresh_cache else probe_cache.load(cache_key, suffix="probe")
+        results = entry["results"] if probe_cache.is_fresh(entry) else {}
+
+        def reachable(address):
+            try:
+                socket.create_connection(address, timeout=runtime_vars[u"probe_timeout"]).close()
+                return True
+            except (socket.error, socket.timeout):
+                return False
+
+        hostnames = [ hostname for hostname in inventory[u"_meta"][u"hostvars"] if not self.behind_jump_host(inventory, hostname) ]
+        addresses = dict( (hostname, self.ssh_address(inventory, hostname)) for hostname in hostnames )
+        unprobed = sorted(set( address for address in addresses.values() if u"%s:%d" % address not in results ))
+        if unprobed:
+            pool = ThreadPool(max(1, min(runtime_vars[u"probe_workers"], len(unprobed))))
+            try:
+                for address, is_reachable in zip(unprobed, pool.map(reachable, unprobed)):
+                    results[u"%s:%d" % address] = is_reachable
+            finally:
+                pool.close()
+                pool.join()
+            probe_cache.store(cache_key, {"timestamp": time.time(), "results": results}, suffix="probe")
+
+        unreachable = set( hostname for hostname in hostnames if not results[u"%s:%d" % addresses[hostname]] )
+        if mode == u"group":
+            inventory[u"skytap_reachable"] = {u"hosts": [ hostname for hostname in hostnames if hostname not in unreachable ], u"vars": {}}
+            inventory[u"skytap_unreachable"] = {u"hosts": [ hostname for hostname in hostnames if hostname in unreachable ], u"vars": {}}
+        elif unreachable:
+            LOG.warning("dropping %d unreachable hosts: %s", len(unreachable), u", ".join(sorted(unreachable)))
+            for group_name, group in inventory.items():
+                if group_name != u"_meta":
+                    group[u"hosts"] = [ hostname for hostname in group[u"hosts"] if hostname not in unreachable ]
+            for hostname in unreachable:
+                del inventory[u"_meta"][u"hostvars"][hostname]
+        return inventory
+
+
+    def hoist_shared_hostvars(self, inventory):
+        """
+        move hostvars every host of a group has in common (usually the credentials) into that group's 
+        vars: skytap_environment first, then each environment's group. A var is only hoisted when no 
+        other group of those hosts sets it, so each host still resolves to the same value.
+        """
+        hostvars = inventory[u"_meta"][u"hostvars"]
+        host_groups = {}
+        for group_name, group in inventory.items():
+            if group_name != u"_meta":
+                for hostname in group[u"hosts"]:
+                    host_groups.setdefault(hostname, set()).add(group_name)
+
+        group_names = [u"skytap_environment"] + [ group_name for group_name, _ in self.environments if len(self.environments) > 1 ]
+        for group_name in group_names:
+            hostnames = [ hostname for hostname in set(inventory[group_name][u"hosts"]) if hostname in hostvars ]
+            if len(hostnames) < 2:
+                continue
+            shared = dict(hostvars[hostnames[0]])
+            for hostname in hostnames[1:]:
+                shared = dict( (var, value) for var, value in shared.items() 
+                                if var in hostvars[hostname] and hostvars[hostname][var] == value )
+            other_groups = set().union(*[ host_groups[hostname] for hostname in hostnames ]) - set([group_name])
+            for other_group in other_groups:
+                for var in inventory[other_group][u"vars"]:
+                    shared.pop(var, None)
+            if not shared:
+                continue
+
+            #the group's vars may be the shared ansible_config_vars dict; don't write through to it
+            group_vars = dict(inventory[group_name][u"vars"])
+            group_vars.update(shared)
+            inventory[group_name][u"vars"] = group_vars
+            for hostname in hostnames:
+                for var in shared:
+                    del hostvars[hostname][var]
+        return inventory
+
+
+    def build_environments(self):
+        network_types = self.requested_network_types()
+        if len(network_types) == 1:
+            parse_method = self.network_types[str(network_types[0])] 
+        else:
+            for network_type in network_types:
+                if network_type not in self.network_types:
+                    raise KeyError(network_type)
+            parse_method = lambda api_data, inventory: self.build_network_type_groups(api_data, inventory, network_types)
+
+        if self.discovery_configured():
+            with self.metrics.stage("discovery"):
+                self._environments = self.discover_environments()
+            if not self.environments:
+                LOG.warning("no Skytap environments match the discovery settings")
+                return self.inventory
+
+        for group_name, configuration_id in self.environments:
+            if group_name in RESERVED_GROUP_NAMES:
+                raise ValueError("environment %s can't have the group name %s; it is reserved" % (configuration_id, group_name))
+
+        if len(self.environments) <= 1:
+            api_data = self.get_data(self.environments[0][1] if self.discovery_configured() else None) 
+            with self.metrics.stage("build"):
+                parse_method(api_data, self.inventory)
+            #a discovered or [environments] named environment keeps its group when it is the only one
+            if self.environments and (self.discovery_configured() or self._environment_names):
+                self.inventory.setdefault(self.environments[0][0], {u"hosts": [], u"vars": {}})[u"hosts"].extend(
+                    self.inventory[u"skytap_environment"][u"hosts"])
+            return self.inventory
+
+        #several environments: one group each, plus every host in the skytap_environment umbrella group
+        env_inventories = []
+        for (group_name, configuration_id), api_data in zip(self.environments, self.get_all_data()):
+            vm_hostname_counts = dict((vm_id, len(hostnames)) for vm_id, hostnames in self._vm_hostnames.items())
+            with self.metrics.stage("build"):
+                env_inventory = parse_method(api_data, {u"skytap_environment": {u"hosts": [], u"vars": {}},
+                                                        u"_meta": {u"hostvars": {}}})
+            #the slice of each VM's hostname list this environment added, so it can be renamed with the hosts below
+            vm_hostname_slices = dict((vm_id, (vm_hostname_counts.get(vm_id, 0), len(hostnames))) 
+                                        for vm_id, hostnames in self._vm_hostnames.items() if len(hostnames) > vm_hostname_counts.get(vm_id, 0))
+            env_inventories.append((group_name, configuration_id, env_inventory, vm_hostname_slices))
+
+        #environments cloned from one template share hostnames; those are qualified with their configuration_id
+        hostname_counts = {}
+        for _, _, env_inventory, _ in env_inventories:
+            for hostname in env_inventory[u"_meta"][u"hostvars"]:
+                hostname_counts[hostname] = hostname_counts.get(hostname, 0) + 1
+        for group_name, configuration_id, env_inventory, vm_hostname_slices in env_inventories:
+            renamed = dict((hostname, u"%s_%s" % (hostname, configuration_id)) for hostname in env_inventory[u"_meta"][u"hostvars"]
+                                if hostname_counts[hostname] > 1)
+            if renamed:
+                self.rename_hosts(env_inventory, renamed, vm_hostname_slices)
+            self.inventory.setdefault(group_name, {u"hosts": [], u"vars": {}})[u"hosts"].extend(env_inventory[u"skytap_environment"][u"hosts"])
+            for env_group_name, group in env_inventory.items():
+                if env_group_name != u"_meta":
+                    self.inventory.setdefault(env_group_name, {u"hosts": [], u"vars": {}})[u"hosts"].extend(group[u"hosts"])
+            self.inventory[u"_meta"][u"hostvars"].update(env_inventory[u"_meta"][u"hostvars"])
+        return self.inventory
+
+
+    def rename_hosts(self, env_inventory, renamed, vm_hostname_slices):
+        """rename hosts in one environment's groups and hostvars, and in the slices of the VM index it added"""
+        for group_name, group in env_inventory.items():
+            if group_name != u"_meta":
+                group[u"hosts"] = [ renamed.get(hostname, hostname) for hostname in group[u"hosts"] ]
+        hostvars = env_inventory[u"_meta"][u"hostvars"]
+        for hostname, new_name in renamed.items():
+            hostvars[new_name] = hostvars.pop(hostname)
+        for vm_id, (start, end) in vm_hostname_slices.items():
+            hostnames = self._vm_hostnames[vm_id]
+            hostnames[start:end] = [ renamed.get(hostname, hostname) for hostname in hostnames[start:end] ]
+
+    def listed_inventory(self):
+        """the inventory --list prints: all of it, or with --changed-only just the hosts in skytap_changed"""
+        inventory = self.get_inventory()
+        if self.changed_only:
+            inventory = self.only_changed_hosts(inventory)
+        return inventory
+
+
     def run_as_script(self): 
         """get the invenotry data, dump it into json string"""
-        return json.dumps(self.get_inventory())
+        inventory = self.listed_inventory()
+        with self.metrics.stage("serialize"):
+            return dump_json(inventory, self.skytap_runtime_vars[u"output_format"])
+
+
+    def write_inventory(self, out):
+        """get the inventory data, and stream it to out as json without holding the whole string in memory"""
+        inventory = self.listed_inventory()
+        with self.metrics.stage("serialize"):
+            write_json(inventory, out, self.skytap_runtime_vars[u"output_format"])
+            out.write("\n")
+
+
+    def report_metrics(self):
+        """emit the collected metrics: JSON on stderr when the metrics var is on, and/or a Prometheus textfile"""
+        if self.skytap_runtime_vars[u"metrics"]:
+            sys.stderr.write(json.dumps(self.metrics.as_dict()) + "\n")
+        if self.skytap_runtime_vars[u"metrics_textfile"]:
+            write_file_atomic(expand_path(self.skytap_runtime_vars[u"metrics_textfile"]), self.metrics.prometheus_text())
+
+class InventoryDaemon(object):
+    """
+    Keeps a SkytapInventory (and its HTTP session) warm, rebuilding the inventory in the 
+    background every interval seconds, and answers list/host requests over a Unix socket. 
+    Failed refreshes back off exponentially, with jitter, up to max_backoff; the last good 
+    inventory is served in the meantime. Only requests carrying the same identity (see 
+    fast_start_identity) as the daemon's are answered.
+    """
+    def __init__(self, inventory, socket_path, interval, max_backoff, identity=None):
+        import threading
+        self.inventory = inventory
+        self.identity = identity
+        self.socket_path = expand_path(socket_path)
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._inventory_json = None
+        self._hostvars = {}
+        self._stopping = threading.Event()
+        self._server = None
+
+    def refresh(self):
+        """rebuild the inventory; True on success"""
+        try:
+            self.inventory.reset_inventory()
+            built = self.inventory.get_inventory()
+        except Exception:
+            self.failures += 1
+            LOG.exception("inventory refresh failed (%d in a row)", self.failures)
+            return False
+        inventory_json = dump_json(built, self.inventory.skytap_runtime_vars[u"output_format"])
+        with self._lock:
+            self._inventory_json = inventory_json
+            self._hostvars = built[u"_meta"][u"hostvars"]
+        self.failures = 0
+        return True
+
+    def next_delay(self):
+        """seconds until the next refresh: the interval, or a growing backoff after failures, +/- 20% jitter"""
+        import random
+        delay = self.interval if not self.failures else min(self.max_backoff, self.interval * (2 ** self.failures))
+        return delay * random.uniform(0.8, 1.2)
+
+    def refresh_loop(self):
+        while not self._stopping.wait(self.next_delay()):
+            self.refresh()
+
+    def answer(self, request):
+        """response body for a request, or None while no inventory has been built yet or it was built from other settings"""
+        if request.get("identity") != self.identity:
+            return None
+        with self._lock:
+            if self._inventory_json is None:
+                return None
+            if request.get("command") == "host":
+                return dump_json(self._hostvars.get(request.get("host"), {}), self.inventory.skytap_runtime_vars[u"output_format"])
+            return self._inventory_json
+
+    def start(self):
+        """bind the socket and start serving in background threads"""
+        import threading
+        from six.moves import socketserver
+        if os.path.exists(self.socket_path):
+            if query_daemon(self.socket_path, {"command": "ping"}) is not None:
+                raise RuntimeError("an inventory daemon is already listening on %s" % self.socket_path)
+            os.remove(self.socket_path)
+        elif not os.path.isdir(os.path.dirname(self.socket_path)):
+            os.makedirs(os.path.dirname(self.socket_path))
+
+        daemon = self
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline())
+                except ValueError:
+                    return
+                response = u"{}" if request.get("command") == "ping" else daemon.answer(request)
+                if response is not None:
+                    self.wfile.write(response.encode("utf-8"))
+
+        self._server = socketserver.ThreadingUnixStreamServer(self.socket_path, RequestHandler)
+        self._server.daemon_threads = True
+        for target in (self._server.serve_forever, self.refresh_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def run(self):
+        """serve until SIGTERM/SIGINT"""
+        import signal
+        self.refresh()
+        self.start()
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._stopping.set())
+        try:
+            while not self._stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+
+def daemon_socket_path():
+    """the socket a thin client looks for; SKYTAP_DAEMON_SOCKET, else the default location"""
+    return expand_path(os.environ.get("SKYTAP_DAEMON_SOCKET", DEFAULT_DAEMON_SOCKET))
+
+
+def query_daemon(socket_path, request, timeout=DAEMON_CLIENT_TIMEOUT):
+    """send a request to a running daemon; None if none is listening or it has nothing to serve yet"""
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(socket_path)
+        client.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except (socket.error, socket.timeout):
+        return None
+    finally:
+        client.close()
+    return b"".join(chunks).decode("utf-8") or None
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    response = fast_start_response(argv)
+    if response is not None:
+        print(response)
+        return
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Ansible dynamic inventory for a Skytap environment")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--list", action="store_true", default=True, help="list all hosts in the environment (default)")
+    mode.add_argument("--host", metavar="HOSTNAME", help="print the variables for a single host")
+    mode.add_argument("--daemon", action="store_true", default=False,
+                      help="keep the inventory warm in memory and serve it over a Unix socket")
+    parser.add_argument("--refresh-cache", action="store_true", default=False, 
+                        help="ignore any cached API response and fetch from the Skytap API")
+    parser.add_argument("--profile", metavar="FILE", help="write a cProfile dump of this run to FILE")
+    parser.add_argument("--changed-only", action="store_true", default=False, 
+                        help="list only the hosts that are new or changed since the previous run")
+    args = parser.parse_args(argv)
+
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    if args.daemon:
+        inventory = SkytapInventory(refresh_cache=args.refresh_cache)
+        runtime_vars = inventory.skytap_runtime_vars
+        InventoryDaemon(inventory, runtime_vars[u"daemon_socket"], runtime_vars[u"daemon_interval"], 
+                        runtime_vars[u"daemon_max_backoff"], identity=fast_start_identity()).run()
+        return
+
+    #thin client: a running daemon answers in milliseconds; otherwise build the inventory directly
+    if not args.refresh_cache and not args.profile and not args.changed_only:
+        request = {"command": "host", "host": args.host} if args.host else {"command": "list"}
+        #the daemon only answers a run with the settings it was started with
+        request["identity"] = fast_start_identity()
+        response = query_daemon(daemon_socket_path(), request)
+        if response is not None:
+            print(response)
+            return
+
+    inventory = SkytapInventory(refresh_cache=args.refresh_cache, changed_only=args.changed_only)
+    try:
+        if args.host:
+            print(dump_json(inventory.get_host(args.host), inventory.skytap_runtime_vars[u"output_format"]))
+        else:
+            inventory.write_inventory(sys.stdout)
+    finally:
+        #failed runs are the ones most worth measuring
+        inventory.report_metrics()
 
-def main():
-    print(SkytapInventory().run_as_script())
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
 
 if __name__ == "__main__":
     main()
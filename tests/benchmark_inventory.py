@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+#Copyright 2015 Skytap Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+
+"""
+Time and memory-profile each stage of the inventory pipeline against synthetic payloads. 
+Results are printed (or written with --output) as JSON, one record per stage and scale, 
+so runs from different releases can be compared. 
+
+    python tests/benchmark_inventory.py --hosts 10,1000,50000 --output bench.json
+"""
+
+"""add parent module to sys.path if running as script"""
+if __name__ == "__main__" and __package__ is None:
+    from os import sys, path
+    sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+    sys.path.append(path.dirname(path.abspath(__file__)))
+
+import argparse
+import json
+import platform
+import resource
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:  #Python 2: no allocation tracing, memory is reported as null
+    tracemalloc = None
+
+from skytap_inventory import SkytapInventory, StreamedConfiguration
+from synthetic_payload import generate_configuration
+
+CONFIG_FIXTURE = "tests/config_fixtures/config_fixture_with_creds.ini"
+DEFAULT_SCALES = "10,100,1000,10000,50000"
+timer = getattr(time, "perf_counter", time.time)
+
+
+def measure(function, repeat):
+    """best wall time over repeat runs, and peak traced memory of one run"""
+    best = None
+    for _ in range(repeat):
+        start = timer()
+        function()
+        elapsed = timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return best, peak
+
+
+class NullWriter(object):
+    """output sink, so write_inventory is timed without the cost of a terminal or file"""
+    def write(self, text):
+        pass
+
+
+def new_inventory(payload=None):
+    inventory = SkytapInventory(None, None, None, CONFIG_FIXTURE)
+    if payload is not None:
+        inventory.get_data = lambda *args: payload
+    return inventory
+
+
+def rebuilt(inventory, method, *args):
+    """call method on a reused instance, starting from an empty inventory each time"""
+    inventory.reset_inventory()
+    return method(*args)
+
+
+def stages(payload, raw):
+    """stage name -> zero argument callable exercising that stage; instances are built beforehand, so construction isn't timed"""
+    chunk_size = StreamedConfiguration.CHUNK_SIZE
+    inventory = new_inventory()
+    scripted = new_inventory(payload)
+    empty = lambda: {u"skytap_environment": {u"hosts": []}, u"_meta": {u"hostvars": {}}}
+    return [
+        ("read_settings", lambda: inventory.read_settings(CONFIG_FIXTURE)),
+        ("json_decode", lambda: json.loads(raw)),
+        ("stream_decode", lambda: sum(1 for _ in StreamedConfiguration(raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size))["vms"])),
+        ("parse_credentials_for_vm", lambda: [ inventory.parse_credentials_for_vm(vm) for vm in payload["vms"] ]),
+        ("build_private_ip_group", lambda: inventory.build_private_ip_group(payload, empty())),
+        ("build_icnr_ip_group", lambda: inventory.build_icnr_ip_group(payload, empty())),
+        ("build_vpn_ip_group", lambda: inventory.build_vpn_ip_group(payload, empty())),
+        ("run_as_script", lambda: rebuilt(scripted, scripted.run_as_script)),
+        ("write_inventory", lambda: rebuilt(scripted, scripted.write_inventory, NullWriter())),
+    ]
+
+
+def run(scales, interfaces_per_vm, vpn_nats, icnr_nats, credentials_per_vm, repeat):
+    results = []
+    for hosts in scales:
+        vm_count = max(1, hosts // interfaces_per_vm)
+        payload = generate_configuration(vm_count, interfaces_per_vm, vpn_nats, icnr_nats, credentials_per_vm)
+        raw = json.dumps(payload).encode("utf-8")
+        for stage, function in stages(payload, raw):
+            seconds, peak_bytes = measure(function, repeat)
+            results.append({"stage": stage,
+                            "hosts": vm_count * interfaces_per_vm,
+                            "payload_bytes": len(raw),
+                            "seconds": seconds,
+                            "peak_bytes": peak_bytes})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the Skytap inventory pipeline against synthetic payloads")
+    parser.add_argument("--hosts", default=DEFAULT_SCALES, help="comma separated host counts (default %s)" % DEFAULT_SCALES)
+    parser.add_argument("--interfaces", type=int, default=1, help="interfaces per VM")
+    parser.add_argument("--vpn-nats", type=int, default=2, help="VPN NAT addresses per interface")
+    parser.add_argument("--icnr-nats", type=int, default=2, help="ICNR NAT addresses per interface")
+    parser.add_argument("--credentials", type=int, default=2, help="credentials per VM")
+    parser.add_argument("--repeat", type=int, default=3, help="timing runs per stage; the best is reported")
+    parser.add_argument("--output", help="write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    scales = [ int(hosts) for hosts in args.hosts.split(",") if hosts.strip() ]
+    report = {"python": platform.python_version(),
+              "timestamp": time.time(),
+              "results": run(scales, args.interfaces, args.vpn_nats, args.icnr_nats, args.credentials, args.repeat)}
+    #process high-water mark; the only memory figure available where tracemalloc is not
+    report["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if args.output:
+        with open(args.output, "w") as output_fh:
+            json.dump(report, output_fh, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
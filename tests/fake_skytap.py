@@ -0,0 +1,246 @@
+#Copyright 2015 Skytap Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+
+"""
+a local stand-in for the Skytap v2 API, for integration, fault and throughput tests. It serves
+
+    configurations/<id>.json          from the configurations dict (fixtures or generated payloads)
+    configurations.json               the listing, paginated with count/offset and a Content-Range total
+    configurations/<id>/vms.json      that configuration's VMs, paginated the same way
+    configurations/<id>/tags.json     that configuration's tags
+    tunnels/<id>.json                 from the tunnels dict
+    vms/<id>/<resource>.json          from the vm_resources dict
+
+with ETag revalidation, and optional latency, 5xx errors, 429 throttling and truncated bodies,
+either at random rates or queued for the next requests.
+"""
+
+import hashlib
+import json
+import random
+import re
+import socket
+import sys
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, urlsplit
+
+
+class FakeSkytapHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, headers=None, truncate=False):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        if truncate:
+            #promise the whole body, send half of it, and hang up
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def send_error_body(self, status, message, headers=None):
+        self.send_body(status, json.dumps({"error": message}).encode("utf-8"), headers)
+
+    def do_GET(self):
+        server = self.server.skytap
+        server.request_started(self.path)
+        try:
+            if server.latency:
+                time.sleep(server.latency)
+            if server.credentials is not None and not server.authorized(self.headers.get("Authorization")):
+                return self.send_error_body(401, "unauthorized")
+
+            fault = server.next_fault()
+            if fault == 429:
+                return self.send_error_body(429, "throttled", {"Retry-After": str(server.retry_after)})
+            if fault in (500, 502, 503, 504):
+                return self.send_error_body(fault, "unavailable")
+
+            status, body, headers = server.route(self.path)
+            if status == 200 and headers.get("ETag") and self.headers.get("If-None-Match") == headers["ETag"]:
+                return self.send_body(304, b"", headers)
+            self.send_body(status, body, headers, truncate=(fault == "truncate"))
+        finally:
+            server.request_finished()
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self.connections = []
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self.process_request_thread, args=(request, client_address))
+        thread.daemon = True
+        self.connections.append((request, thread))
+        thread.start()
+
+    def close_connections(self, timeout):
+        """hang up on kept-alive clients and wait for their handler threads, so none outlive the server"""
+        for request, _ in self.connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for _, thread in self.connections:
+            thread.join(timeout)
+
+    def handle_error(self, request, client_address):
+        #clients giving up mid-response (timeouts, fault tests) are expected; anything else is reported
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class FakeSkytapServer(object):
+    """
+    configurations: {configuration id: payload}; listing: the configurations.json entries;
+    vm_resources: {(vm id, resource): payload}; tunnels: {tunnel id: payload}. error_rate, throttle_rate and truncate_rate are
+    the chances of a request failing that way; queue_faults() scripts the next few instead.
+    """
+    def __init__(self, configurations=None, listing=None, vm_resources=None, tunnels=None, credentials=None, latency=0,
+                 error_rate=0, throttle_rate=0, truncate_rate=0, retry_after=0, seed=0):
+        self.configurations = configurations or {}
+        self.listing = listing or []
+        self.vm_resources = vm_resources or {}
+        self.tunnels = tunnels or {}
+        self.credentials = credentials
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.truncate_rate = truncate_rate
+        self.retry_after = retry_after
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._faults = []
+        self._bodies = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self._httpd.server_address[1]
+
+    def start(self):
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeSkytapHandler)
+        self._httpd.skytap = self
+        thread = threading.Thread(target=self._httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self._httpd.shutdown()
+        self._httpd.close_connections(timeout)
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def queue_faults(self, *faults):
+        """fail the next requests in order: a status (429, 500, 502, 503, 504), "truncate", or None for no fault"""
+        with self._lock:
+            self._faults.extend(faults)
+
+    def next_fault(self):
+        with self._lock:
+            if self._faults:
+                return self._faults.pop(0)
+            roll = self._random.random()
+        if roll < self.error_rate:
+            return 503
+        if roll < self.error_rate + self.throttle_rate:
+            return 429
+        if roll < self.error_rate + self.throttle_rate + self.truncate_rate:
+            return "truncate"
+        return None
+
+    def request_started(self, path):
+        with self._lock:
+            self.requests.append(path)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def request_finished(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def authorized(self, authorization):
+        import base64
+        expected = base64.b64encode(("%s:%s" % self.credentials).encode("utf-8")).decode("ascii")
+        return authorization == "Basic " + expected
+
+    def encoded(self, key, payload):
+        """JSON body and ETag for a payload, encoded once so throughput tests time the client rather than the server"""
+        if key not in self._bodies:
+            body = json.dumps(payload).encode("utf-8")
+            self._bodies[key] = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+        return self._bodies[key]
+
+    def page(self, items, query):
+        """the count/offset slice of items, with a Content-Range total"""
+        offset = int(query.get("offset", ["0"])[0])
+        count = int(query.get("count", [str(len(items) or 1)])[0])
+        page = items[offset:offset + count]
+        last = offset + len(page) - 1
+        return 200, json.dumps(page).encode("utf-8"), {"Content-Range": "items %d-%d/%d" % (offset, last, len(items))}
+
+    def route(self, path):
+        """(status, body, headers) for a GET of path"""
+        parts = urlsplit(path)
+        query = parse_qs(parts.query)
+
+        match = re.match(r"^/configurations/([^/]+)\.json$", parts.path)
+        if match and match.group(1) in self.configurations:
+            body, etag = self.encoded(parts.path, self.configurations[match.group(1)])
+            return 200, body, {"ETag": etag}
+
+        if parts.path == "/configurations.json":
+            return self.page(self.listing, query)
+
+        match = re.match(r"^/configurations/([^/]+)/(vms|tags)\.json$", parts.path)
+        if match and match.group(1) in self.configurations:
+            items = self.configurations[match.group(1)].get(match.group(2)) or []
+            if match.group(2) == "tags":
+                return 200, json.dumps(items).encode("utf-8"), {}
+            return self.page(items, query)
+
+        match = re.match(r"^/tunnels/([^/]+)\.json$", parts.path)
+        if match and match.group(1) in self.tunnels:
+            return 200, json.dumps(self.tunnels[match.group(1)]).encode("utf-8"), {}
+
+        match = re.match(r"^/vms/([^/]+)/([^/]+)\.json$", parts.path)
+        if match and match.groups() in self.vm_resources:
+            body, etag = self.encoded(parts.path, self.vm_resources[match.groups()])
+            return 200, body, {"ETag": etag}
+
+        return 404, json.dumps({"error": "not found: %s" % parts.path}).encode("utf-8"), {}
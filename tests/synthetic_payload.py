@@ -0,0 +1,74 @@
+#Copyright 2015 Skytap Inc.
+#
+#Licensed under the Apache License, Version 2.0 (the "License");
+#you may not use this file except in compliance with the License.
+#You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#Unless required by applicable law or agreed to in writing, software
+#distributed under the License is distributed on an "AS IS" BASIS,
+#WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#See the License for the specific language governing permissions and
+#limitations under the License.
+
+
+"""generate configurations payloads shaped like the Skytap v2 API response, at any scale"""
+
+FIXTURE_URL = "https://_test_fixture_.net"
+
+
+def ip_address(index, base=10):
+    return "%d.%d.%d.%d" % (base, (index >> 16) & 255, (index >> 8) & 255, index & 255)
+
+
+def generate_interface(vm_index, interface_index, host_index, vpn_nats, icnr_nats):
+    hostname = "host-%d-%d" % (vm_index, interface_index)
+    return {
+        "id": "nic-%07d-%d" % (vm_index, interface_index),
+        "vm_id": "%07d" % vm_index,
+        "vm_name": "vm-%d" % vm_index,
+        "hostname": hostname,
+        "ip": ip_address(host_index),
+        "status": "Running",
+        "network_id": "%07d" % interface_index,
+        "network_name": "network-%d" % interface_index,
+        "network_subnet": "10.%d.0.0/16" % interface_index,
+        "network_url": "%s/configurations/0000000/networks/%07d" % (FIXTURE_URL, interface_index),
+        "nat_addresses": {
+            "vpn_nat_addresses": [ {"vpn_id": "vpn-%06d" % nat,
+                                    "vpn_name": "VPN %d" % nat,
+                                    "vpn_url": "%s/vpns/vpn-%06d" % (FIXTURE_URL, nat),
+                                    "ip_address": ip_address(host_index, 100 + nat)} for nat in range(vpn_nats) ],
+            "network_nat_addresses": [ {"network_id": "%07d" % nat,
+                                        "network_name": "ICNR network %d" % nat,
+                                        "network_url": "%s/configurations/1111111/networks/%07d" % (FIXTURE_URL, nat),
+                                        "configuration_id": "1111111",
+                                        "ip_address": ip_address(host_index, 150 + nat)} for nat in range(icnr_nats) ],
+        },
+    }
+
+
+def generate_configuration(vm_count, interfaces_per_vm=1, vpn_nats=1, icnr_nats=1, credentials_per_vm=2):
+    """a configuration with vm_count VMs of interfaces_per_vm interfaces each (vm_count * interfaces_per_vm hosts)"""
+    vms = []
+    for vm_index in range(vm_count):
+        interfaces = [ generate_interface(vm_index, interface_index, vm_index * interfaces_per_vm + interface_index, vpn_nats, icnr_nats)
+                        for interface_index in range(interfaces_per_vm) ]
+        credentials = [ {"id": "%07d" % cred, "text": "user%d / password%d" % (cred, vm_index)} for cred in range(credentials_per_vm) ]
+        vms.append({"id": "%07d" % vm_index,
+                    "name": "vm-%d" % vm_index,
+                    "runstate": "running",
+                    "configuration_url": "%s/configurations/0000000" % FIXTURE_URL,
+                    "interfaces": interfaces,
+                    "credentials": credentials,
+                    "hardware": {"cpus": 1, "ram": 2048, "guestOS": "ubuntu-64", "disks": [ {"size": 10240, "type": "SCSI"} ]}})
+
+    return {"id": "0000000",
+            "name": "synthetic-%d" % vm_count,
+            "runstate": "running",
+            "url": "%s/configurations/0000000" % FIXTURE_URL,
+            "networks": [ {"id": "%07d" % index, "name": "network-%d" % index, "subnet": "10.%d.0.0/16" % index}
+                            for index in range(interfaces_per_vm) ],
+            "tunnels": [],
+            "vms": vms}
@@ -22,14 +22,21 @@ if __name__ == "__main__" and __package__ is None:
 
 import os
 import json
+import shutil
 import six
+import subprocess
+import sys
+import tempfile
+import time
 from six.moves import configparser
 import unittest
 
 import mock
 from mock import MagicMock  #pip install mock for Python 2.7 
 
-from skytap_inventory import SkytapInventory
+from skytap_inventory import SkytapInventory, Client, InventoryDaemon, Metrics, ResponseCache, StreamedConfiguration, query_daemon, retry_policy, write_json
+from tests.fake_skytap import FakeSkytapServer
+from tests.synthetic_payload import FIXTURE_URL, generate_configuration
 
 class UnsetSkytapEnvironmentVarsTestCase(unittest.TestCase):
     def setUp(self):
@@ -63,7 +70,9 @@ class TestInstantiationMethods(UnsetSkytapEnvironmentVarsTestCase):
         mock_client.return_value = None
         SkytapInventory()
         mock_read_settings.assert_called_once_with(None)
-        mock_client.assert_called_once_with(mock.ANY, mock.ANY, mock.ANY)
+        mock_client.assert_called_once_with(mock.ANY, mock.ANY, mock.ANY, pool_maxsize=mock.ANY, metrics=mock.ANY,
+                                            max_retries=mock.ANY, backoff_factor=mock.ANY, max_retry_after=mock.ANY,
+                                            connect_timeout=mock.ANY, read_timeout=mock.ANY)
 
 
 class TestRuntimeMethods(UnsetSkytapEnvironmentVarsTestCase):
@@ -77,6 +86,163 @@ class TestRuntimeMethods(UnsetSkytapEnvironmentVarsTestCase):
         test_inv.get_data()
         mock_get.assert_called_once_with(expected_calling_url)
 
+    def test_environments_from_configuration_id_list(self):
+        os.environ['SKYTAP_CONFIGURATION_ID'] = '111, 222'
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        self.assertEqual([(u"skytap_environment_111", u"111"), (u"skytap_environment_222", u"222")], test_inv.environments)
+
+    def test_environments_section(self):
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_environments.ini")
+        self.assertEqual([(u"web_tier", u"1111111"), (u"db_tier", u"2222222")], test_inv.environments)
+
+    def test_multiple_environments_merge(self):
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            api_response = json.loads(api_fh.read())
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_environments.ini")
+        test_inv.get_data = MagicMock(return_value=api_response)
+        actual = test_inv.get_inventory()
+
+        self.assertEqual(2, test_inv.get_data.call_count)
+        self.assertEqual([u"xyz1_1111111"], actual[u"web_tier"][u"hosts"])
+        self.assertEqual([u"xyz1_2222222"], actual[u"db_tier"][u"hosts"])
+        self.assertEqual([u"xyz1_1111111", u"xyz1_2222222"], actual[u"skytap_environment"][u"hosts"])
+
+    def test_cloned_environments_keep_their_hosts_apart(self):
+        os.environ['SKYTAP_CONFIGURATION_ID'] = '111, 222'
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_groups.ini")
+        payloads = {"111": generate_configuration(2), "222": generate_configuration(3)}
+        for vm in payloads["222"]["vms"]:
+            vm["interfaces"][0]["ip"] = vm["interfaces"][0]["ip"].replace("10.", "172.", 1)
+        test_inv.get_data = lambda configuration_id=None: payloads[configuration_id]
+        actual = test_inv.get_inventory()
+
+        self.assertEqual([u"host-0-0_111", u"host-1-0_111"], actual[u"skytap_environment_111"][u"hosts"])
+        self.assertEqual([u"host-0-0_222", u"host-1-0_222", u"host-2-0"], actual[u"skytap_environment_222"][u"hosts"])
+        self.assertEqual(u"10.0.0.0", actual[u"_meta"][u"hostvars"][u"host-0-0_111"][u"ansible_ssh_host"])
+        self.assertEqual(u"172.0.0.0", actual[u"_meta"][u"hostvars"][u"host-0-0_222"][u"ansible_ssh_host"])
+        self.assertEqual(5, len(actual[u"_meta"][u"hostvars"]))
+        self.assertEqual(5, len(actual[u"skytap_runstate_running"][u"hosts"]))
+
+    def test_environments_sharing_a_name_share_a_group(self):
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv._environments = [(u"ci", u"111"), (u"ci", u"222")]
+        payloads = {"111": generate_configuration(1), "222": generate_configuration(2)}
+        test_inv.get_data = lambda configuration_id=None: payloads[configuration_id]
+        actual = test_inv.get_inventory()
+
+        self.assertEqual([u"host-0-0_111", u"host-0-0_222", u"host-1-0"], actual[u"ci"][u"hosts"])
+        self.assertEqual(u"_ANSIBLE-SSH-USER_", actual[u"skytap_environment"][u"vars"][u"ansible_ssh_user"])
+
+    def test_reserved_environment_group_name(self):
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv._environments = [(u"skytap_environment", u"111"), (u"ci", u"222")]
+        test_inv.get_data = MagicMock(return_value=generate_configuration(1))
+        self.assertRaises(ValueError, test_inv.build_inventory)
+
+    @mock.patch("skytap_inventory.Client.get")
+    @mock.patch("skytap_inventory.Client.get_response")
+    def test_get_paginated_fetches_remaining_pages(self, mock_get_response, mock_get):
+        mock_get_response.return_value = MagicMock(headers={"Content-Range": "items 0-1/5"}, json=MagicMock(return_value=[1, 2]))
+        mock_get.side_effect = lambda resource, count, offset: list(range(offset + 1, min(offset + count, 5) + 1))
+        client = Client("https://_testfixture_.net/", "user", "token")
+
+        self.assertEqual([1, 2, 3, 4, 5], client.get_paginated("configurations.json", page_size=2, max_workers=4))
+        self.assertEqual(2, mock_get.call_count)
+
+    def test_discover_environments(self):
+        listing = [{"id": "1", "name": "ci-one", "tags": [{"id": "t1", "value": "ci-pool"}]},
+                   {"id": "2", "name": "ci-two", "tags": []},
+                   {"id": "3", "name": "prod", "tags": [{"id": "t1", "value": "ci-pool"}]}]
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_discovery.ini")
+        test_inv._client.get_paginated = MagicMock(return_value=listing)
+        self.assertTrue(test_inv.discovery_configured())
+        self.assertEqual([(u"ci_one", u"1")], test_inv.discover_environments())
+
+    def test_single_discovered_environment_gets_its_group(self):
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_discovery.ini")
+        test_inv._client.get_paginated = MagicMock(return_value=[{"id": "1", "name": "ci-one", "tags": ["ci-pool"]},
+                                                                 {"id": "2", "name": "prod", "tags": []}])
+        test_inv.get_data = MagicMock(return_value=generate_configuration(2))
+        actual = test_inv.get_inventory()
+
+        test_inv.get_data.assert_called_once_with(u"1")
+        self.assertEqual([u"host-0-0", u"host-1-0"], actual[u"ci_one"][u"hosts"])
+        self.assertEqual([u"host-0-0", u"host-1-0"], actual[u"skytap_environment"][u"hosts"])
+
+    def test_discovered_reserved_name_is_renamed(self):
+        os.environ['SKYTAP_DISCOVER_NAME'] = '*'
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_discovery.ini")
+        test_inv._client.get_paginated = MagicMock(return_value=[{"id": "1", "name": "all", "tags": ["ci-pool"]},
+                                                                 {"id": "2", "name": "ci-two", "tags": ["ci-pool"]}])
+        with mock.patch("skytap_inventory.LOG") as mock_log:
+            self.assertEqual([(u"skytap_environment_1", u"1"), (u"ci_two", u"2")], test_inv.discover_environments())
+        self.assertTrue(mock_log.warning.called)
+
+    def test_discovery_results_cached(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            os.environ['SKYTAP_DISCOVERY_CACHE_TTL'] = '60'
+            os.environ['SKYTAP_CACHE_PATH'] = cache_dir
+            test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_discovery.ini")
+            test_inv._client.get_paginated = MagicMock(return_value=[{"id": "1", "name": "ci-one", "tags": ["ci-pool"]}])
+            test_inv.discover_environments()
+            self.assertEqual([(u"ci_one", u"1")], test_inv.discover_environments())
+            self.assertEqual(1, test_inv._client.get_paginated.call_count)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_enrichment_merged_into_hostvars(self):
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            api_response = json.loads(api_fh.read())
+        os.environ['SKYTAP_ENRICH_RESOURCES'] = 'user_data, metadata'
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv.get_data = MagicMock(return_value=api_response)
+        test_inv._client.get = MagicMock(side_effect=lambda url: {"url": url})
+        hostvars = test_inv.get_inventory()[u"_meta"][u"hostvars"][u"xyz1"]
+
+        self.assertEqual(2, test_inv._client.get.call_count)
+        self.assertTrue(hostvars[u"skytap_user_data"]["url"].endswith("vms/0000000/user_data.json"))
+        self.assertTrue(hostvars[u"skytap_metadata"]["url"].endswith("vms/0000000/metadata.json"))
+
+    def test_enrichment_survives_connection_errors(self):
+        import requests
+        os.environ['SKYTAP_ENRICH_RESOURCES'] = 'user_data, metadata'
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv.get_data = MagicMock(return_value=generate_configuration(2, credentials_per_vm=1))
+        def get(url):
+            if "0000000/user_data" in url:
+                raise requests.ConnectionError("connection reset")
+            if "0000001/metadata" in url:
+                raise requests.Timeout("read timed out")
+            return {"url": url}
+        test_inv._client.get = MagicMock(side_effect=get)
+        with mock.patch("skytap_inventory.LOG") as mock_log:
+            hostvars = test_inv.get_inventory()[u"_meta"][u"hostvars"]
+
+        self.assertEqual([u"skytap_metadata"], [ var for var in hostvars[u"host-0-0"] if var.startswith(u"skytap_") ])
+        self.assertEqual([u"skytap_user_data"], [ var for var in hostvars[u"host-1-0"] if var.startswith(u"skytap_") ])
+        #warnings come from the pool's threads, and a mock's call count isn't thread safe on python 2
+        self.assertTrue(mock_log.warning.called)
+
+    def test_enrichment_cached_by_vm(self):
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            api_response = json.loads(api_fh.read())
+        cache_dir = tempfile.mkdtemp()
+        try:
+            os.environ['SKYTAP_ENRICH_RESOURCES'] = 'user_data'
+            os.environ['SKYTAP_ENRICH_CACHE_TTL'] = '60'
+            os.environ['SKYTAP_CACHE_PATH'] = cache_dir
+            for _ in range(2):
+                test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+                test_inv.get_data = MagicMock(return_value=api_response)
+                test_inv._client.get_response = MagicMock(return_value=MagicMock(status_code=200, headers={}))
+                test_inv._client.decode = MagicMock(return_value={"contents": "#cloud-config"})
+                actual = test_inv.get_inventory()
+            self.assertEqual({"contents": "#cloud-config"}, actual[u"_meta"][u"hostvars"][u"xyz1"][u"skytap_user_data"])
+            self.assertEqual(0, test_inv._client.get_response.call_count)
+        finally:
+            shutil.rmtree(cache_dir)
+
 
 
 class TestParseMethods(UnsetSkytapEnvironmentVarsTestCase):
@@ -179,17 +345,993 @@ class TestParseMethods(UnsetSkytapEnvironmentVarsTestCase):
         self.assertDictEqual(self.expected_inventory_no_api_creds, actual_result_no_creds)
 
 
+    def test_extract_hosts_single_pass(self):
+        mock_api_data = self.test_instance_with_api_creds.get_data()
+        records = list(self.test_instance_with_api_creds.extract_hosts(mock_api_data, ("private", "nat_icnr", "nat_vpn")))
+        self.assertEqual(1, len(records))
+        self.assertEqual(u"0.0.0.0", records[0].private_ip)
+        self.assertEqual([u"0.0.0.0"], records[0].icnr_ips)
+        self.assertEqual(u"0.0.0.0", records[0].vpn_ip)
+        self.assertFalse(hasattr(records[0], "__dict__"))
+
+
+    def test_parse_several_network_types(self):
+        mock_api_data = self.test_instance_with_api_creds.get_data()
+        actual = self.test_instance_with_api_creds.build_network_type_groups(mock_api_data, 
+                        self.test_instance_with_api_creds.inventory, [u"nat_vpn", u"private"])
+        self.assertEqual([u"xyz1"], actual[u"skytap_environment"][u"hosts"])
+        self.assertEqual([u"xyz1"], actual[u"skytap_nat_vpn"][u"hosts"])
+        self.assertEqual([u"xyz1"], actual[u"skytap_private"][u"hosts"])
+        self.assertEqual(u"0.0.0.0", actual[u"_meta"][u"hostvars"][u"xyz1"][u"skytap_private_ip"])
+        self.assertEqual(u"_FAKEPASS_", actual[u"_meta"][u"hostvars"][u"xyz1"][u"ansible_ssh_pass"])
+
+
+    def test_attribute_groups(self):
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_groups.ini")
+        payload = generate_configuration(3, interfaces_per_vm=2)
+        payload["vms"][0]["runstate"] = "stopped"
+        payload["tags"] = [{"id": "1", "value": "ci-pool"}]
+        actual = test_inv.build_private_ip_group(payload, test_inv.inventory)
+
+        self.assertEqual([u"host-0-0", u"host-0-1"], actual[u"skytap_runstate_stopped"][u"hosts"])
+        self.assertEqual(4, len(actual[u"skytap_runstate_running"][u"hosts"]))
+        self.assertEqual([u"host-0-0", u"host-0-1"], actual[u"skytap_name_prefix_vm"][u"hosts"][:2])
+        self.assertEqual(3, len(actual[u"skytap_network_name_network_1"][u"hosts"]))
+        self.assertEqual(3, len(actual[u"skytap_subnet_10_0_0_0_16"][u"hosts"]))
+        self.assertEqual(6, len(actual[u"skytap_tag_ci_pool"][u"hosts"]))
+
+
+    def test_no_attribute_groups_by_default(self):
+        mock_api_data = self.test_instance_with_api_creds.get_data()
+        actual = self.test_instance_with_api_creds.build_private_ip_group(mock_api_data, self.test_instance_with_api_creds.inventory)
+        self.assertEqual(set([u"skytap_environment", u"_meta"]), set(actual))
+
+
+    def test_parse_synthetic_payload(self):
+        payload = generate_configuration(5, interfaces_per_vm=2, vpn_nats=3, icnr_nats=2, credentials_per_vm=2)
+        actual = self.test_instance_no_api_creds.build_vpn_ip_group(payload, self.test_instance_no_api_creds.inventory)
+        self.assertEqual(10, len(actual[u"_meta"][u"hostvars"]))
+        self.assertEqual(u"100.0.0.9", actual[u"_meta"][u"hostvars"][u"host-4-1"][u"ansible_ssh_host"])
+
+
+    def test_parse_streamed_configuration(self):
+        with open("tests/api_response_fixture.json", "rb") as api_fh:
+            raw = api_fh.read()
+        chunks = [ raw[i:i + 7] for i in range(0, len(raw), 7) ]
+
+        streamed = StreamedConfiguration(chunks)
+        actual_result = self.test_instance_with_api_creds.build_vpn_ip_group(streamed, self.test_instance_with_api_creds.inventory)
+        self.assertDictEqual(self.expected_inventory_with_api_creds, actual_result)
+        self.assertEqual(self.mock_api_response["name"], streamed["name"])
+
+
+    def test_streamed_fields_after_vms(self):
+        streamed = StreamedConfiguration([b'{"vms": [{"id": 1}, {"id": 22}], "tunnels": [], "count": 12', b'345}'])
+        self.assertEqual([], streamed["tunnels"])
+        self.assertEqual([{"id": 1}, {"id": 22}], list(streamed["vms"]))
+        self.assertEqual(12345, streamed["count"])
+
+
+    def test_truncated_stream_raises(self):
+        streamed = StreamedConfiguration([b'{"name": "x", "vms": [{"id": 1}, {"id"'])
+        self.assertRaises(ValueError, list, streamed["vms"])
+
+
     #end-to-end test with one of the credentials parsing methods
     def test_run_as_script(self):
         actual_result = json.loads(SkytapInventory.run_as_script(self.test_instance_with_api_creds))
         self.assertDictEqual(self.expected_inventory_with_api_creds, actual_result) 
+
+    def test_streamed_output_matches_json_dumps(self):
+        inventory = self.test_instance_with_api_creds.get_inventory()
+        out = six.StringIO()
+        write_json(inventory, out)
+        self.assertEqual(json.dumps(inventory), out.getvalue())
+
+    def test_hoist_shared_hostvars(self):
+        inventory = {u"skytap_environment": {u"hosts": [u"a", u"b"], u"vars": {u"ansible_ssh_port": u"22"}},
+                     u"skytap_runstate_running": {u"hosts": [u"a"], u"vars": {u"ansible_ssh_pass": u"other"}},
+                     u"_meta": {u"hostvars": {u"a": {u"ansible_ssh_user": u"root", u"ansible_ssh_pass": u"pw", u"ansible_ssh_host": u"10.0.0.1"},
+                                              u"b": {u"ansible_ssh_user": u"root", u"ansible_ssh_pass": u"pw", u"ansible_ssh_host": u"10.0.0.2"}}}}
+        self.test_instance_with_api_creds.hoist_shared_hostvars(inventory)
+
+        self.assertEqual({u"ansible_ssh_port": u"22", u"ansible_ssh_user": u"root"}, inventory[u"skytap_environment"][u"vars"])
+        self.assertEqual({u"ansible_ssh_pass": u"pw", u"ansible_ssh_host": u"10.0.0.1"}, inventory[u"_meta"][u"hostvars"][u"a"])
+        self.assertEqual({u"ansible_ssh_pass": u"pw", u"ansible_ssh_host": u"10.0.0.2"}, inventory[u"_meta"][u"hostvars"][u"b"])
+
+    def test_hoist_leaves_config_vars_untouched(self):
+        os.environ['SKYTAP_HOIST_HOSTVARS'] = 'true'
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        payload = generate_configuration(3)
+        for vm in payload["vms"]:
+            vm["credentials"] = [{"id": "0000000", "text": "_FAKEUSER_ / secret"}]
+        test_inv.get_data = MagicMock(return_value=payload)
+        actual = test_inv.get_inventory()
+
+        self.assertEqual(u"secret", actual[u"skytap_environment"][u"vars"][u"ansible_ssh_pass"])
+        self.assertEqual([u"ansible_ssh_host"], list(actual[u"_meta"][u"hostvars"][u"host-0-0"]))
+        self.assertEqual(self.test_instance_with_api_creds.ansible_config_vars, test_inv.ansible_config_vars)
+
+    def test_ssh_tuning_for_nat_hosts(self):
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_ssh_tuning.ini")
+        payload = generate_configuration(2)
+        payload["vms"][0]["interfaces"][0]["nat_addresses"]["vpn_nat_addresses"] = []
+        test_inv.get_data = MagicMock(return_value=payload)
+        hostvars = test_inv.get_inventory()[u"_meta"][u"hostvars"]
+
+        self.assertEqual(u"-o ControlMaster=auto -o ControlPersist=60s -o ControlPath=/tmp/skytap-%C "
+                         u"-o ProxyJump=jump@bastion.example.com:2222", hostvars[u"host-1-0"][u"ansible_ssh_common_args"])
+        self.assertEqual(True, hostvars[u"host-1-0"][u"ansible_pipelining"])
+        #host-0-0 has no VPN address, so Ansible reaches it over the private network
+        self.assertNotIn(u"ansible_ssh_common_args", hostvars[u"host-0-0"])
+        self.assertNotIn(u"ansible_pipelining", hostvars[u"host-0-0"])
+
+    def test_no_ssh_tuning_by_default(self):
+        self.assertEqual({}, self.test_instance_with_api_creds.ssh_tuning_vars())
+        hostvars = self.test_instance_with_api_creds.get_inventory()[u"_meta"][u"hostvars"]
+        for host in hostvars.values():
+            self.assertNotIn(u"ansible_ssh_common_args", host)
+
+    def test_compact_output(self):
+        os.environ['SKYTAP_OUTPUT_FORMAT'] = 'compact'
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv.get_data = MagicMock(return_value=self.mock_api_response)
+        out = six.StringIO()
+        test_inv.write_inventory(out)
+        self.assertNotIn(", ", out.getvalue())
+        self.assertDictEqual(self.expected_inventory_with_api_creds, json.loads(out.getvalue()))
         
 
+class TestResponseCache(UnsetSkytapEnvironmentVarsTestCase):
+    def setUp(self):
+        UnsetSkytapEnvironmentVarsTestCase.setUp(self)
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.cache_dir, 60)
+        self.mock_client = MagicMock()
+        self.mock_client.get_response.return_value = MagicMock(status_code=200, 
+                headers={"ETag": '"v1"', "Last-Modified": "Thu, 01 Jan 2015 00:00:00 GMT"},
+                json=MagicMock(return_value={"vms": []}))
+        self.mock_client.decode.side_effect = lambda response: response.json()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        UnsetSkytapEnvironmentVarsTestCase.tearDown(self)
+
+    def test_fresh_entry_skips_api(self):
+        self.cache.fetch(self.mock_client, "url", "key")
+        self.assertEqual({"vms": []}, self.cache.fetch(self.mock_client, "url", "key"))
+        self.assertEqual(1, self.mock_client.get_response.call_count)
+
+    def test_stale_entry_is_revalidated(self):
+        self.cache.fetch(self.mock_client, "url", "key")
+        entry = self.cache.load("key")
+        entry["timestamp"] = time.time() - 120
+        self.cache.store("key", entry)
+        self.mock_client.get_response.return_value = MagicMock(status_code=304, headers={})
+
+        self.assertEqual({"vms": []}, self.cache.fetch(self.mock_client, "url", "key"))
+        self.mock_client.get_response.assert_called_with("url", headers={"If-None-Match": '"v1"', 
+                                                                         "If-Modified-Since": "Thu, 01 Jan 2015 00:00:00 GMT"})
+        self.assertTrue(self.cache.is_fresh(self.cache.load("key")))
+
+    def test_refresh_ignores_cache(self):
+        self.cache.fetch(self.mock_client, "url", "key")
+        self.cache.fetch(self.mock_client, "url", "key", refresh=True)
+        self.mock_client.get_response.assert_called_with("url", headers={})
+        self.assertEqual(2, self.mock_client.get_response.call_count)
+
+    def test_host_answered_from_index(self):
+        os.environ['SKYTAP_CACHE_TTL'] = '300'
+        os.environ['SKYTAP_CACHE_PATH'] = self.cache_dir
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            api_response = json.loads(api_fh.read())
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv.get_data = MagicMock(return_value=api_response)
+        test_inv.get_inventory()
+
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv.get_data = MagicMock(return_value=api_response)
+        self.assertEqual(u"0.0.0.0", test_inv.get_host(u"xyz1")[u"ansible_ssh_host"])
+        self.assertEqual({}, test_inv.get_host(u"no-such-host"))
+        self.assertFalse(test_inv.get_data.called)
+
+    def test_host_without_cache_builds_inventory(self):
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            api_response = json.loads(api_fh.read())
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv.get_data = MagicMock(return_value=api_response)
+        self.assertEqual(u"_FAKEUSER_", test_inv.get_host(u"xyz1")[u"ansible_ssh_user"])
+        self.assertTrue(test_inv.get_data.called)
+
+    def test_cache_ttl_from_environment(self):
+        os.environ['SKYTAP_CACHE_TTL'] = '300'
+        os.environ['SKYTAP_CACHE_PATH'] = self.cache_dir
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        self.assertEqual(300, test_inv.skytap_runtime_vars[u"cache_ttl"])
+        self.assertEqual(300, test_inv.response_cache.ttl)
+
+    def test_single_flight_shares_one_fetch(self):
+        import threading
+        def slow_response(url, headers):
+            time.sleep(0.3)
+            return self.mock_client.get_response.return_value
+        self.mock_client.get_response.side_effect = slow_response
+        cache = ResponseCache(self.cache_dir, 0, single_flight=True)
+        results = []
+        threads = [ threading.Thread(target=lambda: results.append(cache.fetch(self.mock_client, "url", "key"))) for _ in range(5) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([{"vms": []}] * 5, results)
+        self.assertEqual(1, self.mock_client.get_response.call_count)
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "key.lock")))
+
+    def test_lock_of_dead_holder_is_broken(self):
+        import socket
+        finished = subprocess.Popen([sys.executable, "-c", "pass"])
+        finished.wait()
+        with open(os.path.join(self.cache_dir, "key.lock"), "w") as lock_fh:
+            json.dump({"pid": finished.pid, "host": socket.gethostname()}, lock_fh)
+        cache = ResponseCache(self.cache_dir, 0, single_flight=True, lock_timeout=30)
+        started = time.time()
+        with mock.patch("skytap_inventory.LOG"):
+            self.assertEqual({"vms": []}, cache.fetch(self.mock_client, "url", "key"))
+        self.assertTrue(time.time() - started < 5)
+
+    def test_old_lock_is_broken(self):
+        lock_path = os.path.join(self.cache_dir, "key.lock")
+        with open(lock_path, "w") as lock_fh:
+            json.dump({"pid": 1, "host": "another-host"}, lock_fh)
+        os.utime(lock_path, (time.time() - 600, time.time() - 600))
+        cache = ResponseCache(self.cache_dir, 0, single_flight=True, lock_timeout=30, lock_stale_after=300)
+        with mock.patch("skytap_inventory.LOG"):
+            self.assertEqual({"vms": []}, cache.fetch(self.mock_client, "url", "key"))
+
+    def test_lock_wait_gives_up(self):
+        with open(os.path.join(self.cache_dir, "key.lock"), "w") as lock_fh:
+            json.dump({"pid": 1, "host": "another-host"}, lock_fh)
+        cache = ResponseCache(self.cache_dir, 0, single_flight=True, lock_timeout=0.2)
+        with mock.patch("skytap_inventory.LOG") as mock_log:
+            self.assertEqual({"vms": []}, cache.fetch(self.mock_client, "url", "key"))
+        self.assertTrue(mock_log.warning.called)
+
+
+class TestInventoryDaemon(UnsetSkytapEnvironmentVarsTestCase):
+    def setUp(self):
+        UnsetSkytapEnvironmentVarsTestCase.setUp(self)
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            self.api_response = json.loads(api_fh.read())
+        with open("tests/dynamic_inventory_fixture_with_api_creds.json", "r") as inv_fh:
+            self.expected_inventory = json.loads(inv_fh.read())
+        self.socket_dir = tempfile.mkdtemp()
+        self.test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        self.test_inv.get_data = MagicMock(return_value=self.api_response)
+        self.daemon = InventoryDaemon(self.test_inv, os.path.join(self.socket_dir, "inventory.sock"), 3600, 7200)
+
+    def tearDown(self):
+        self.daemon.stop()
+        shutil.rmtree(self.socket_dir)
+        UnsetSkytapEnvironmentVarsTestCase.tearDown(self)
+
+    def test_serves_list_and_host(self):
+        self.daemon.start()
+        self.assertEqual(None, query_daemon(self.daemon.socket_path, {"command": "list"}))
+
+        self.assertTrue(self.daemon.refresh())
+        self.assertDictEqual(self.expected_inventory, json.loads(query_daemon(self.daemon.socket_path, {"command": "list"})))
+        self.assertEqual(u"0.0.0.0", json.loads(query_daemon(self.daemon.socket_path, {"command": "host", "host": "xyz1"}))[u"ansible_ssh_host"])
+
+    def test_refresh_rebuilds_from_empty(self):
+        self.daemon.refresh()
+        self.daemon.refresh()
+        self.assertEqual([u"xyz1"], self.test_inv.inventory[u"skytap_environment"][u"hosts"])
+
+    def test_failed_refresh_backs_off(self):
+        self.daemon.refresh()
+        self.test_inv.get_data.side_effect = Exception("API unavailable")
+        self.assertFalse(self.daemon.refresh())
+        self.assertFalse(self.daemon.refresh())
+        delay = self.daemon.next_delay()
+        self.assertTrue(7200 * 0.8 <= delay <= 7200 * 1.2)
+        self.assertDictEqual(self.expected_inventory, json.loads(self.daemon.answer({"command": "list"})))
+
+    def test_serves_configured_output_format(self):
+        self.test_inv.skytap_runtime_vars[u"output_format"] = u"compact"
+        self.daemon.refresh()
+        listed = self.daemon.answer({"command": "list"})
+        self.assertDictEqual(self.expected_inventory, json.loads(listed))
+        self.assertFalse(", " in listed or ": " in listed)
+        self.assertFalse(", " in self.daemon.answer({"command": "host", "host": "xyz1"}))
+
+    def test_answers_only_its_own_settings(self):
+        import skytap_inventory
+        ini = "tests/config_fixtures/config_fixture_with_creds.ini"
+        self.daemon.identity = skytap_inventory.fast_start_identity(ini)
+        self.daemon.start()
+        self.daemon.refresh()
+        own = {"command": "list", "identity": skytap_inventory.fast_start_identity(ini)}
+        self.assertDictEqual(self.expected_inventory, json.loads(query_daemon(self.daemon.socket_path, own)))
+
+        os.environ['SKYTAP_NETWORK_TYPE'] = 'private'
+        other = {"command": "list", "identity": skytap_inventory.fast_start_identity(ini)}
+        self.assertEqual(None, query_daemon(self.daemon.socket_path, other))
+        self.assertEqual(None, query_daemon(self.daemon.socket_path, {"command": "list"}))
+
+    @mock.patch("skytap_inventory.fast_start_response", return_value=None)
+    @mock.patch("skytap_inventory.query_daemon", return_value=u"{}")
+    def test_thin_client_sends_its_identity(self, mock_query, mock_fast_start):
+        import skytap_inventory
+        with mock.patch("sys.stdout", new=six.StringIO()):
+            skytap_inventory.main(["--list"])
+        self.assertEqual(skytap_inventory.fast_start_identity(), mock_query.call_args[0][1]["identity"])
+
+    def test_no_daemon_listening(self):
+        self.assertEqual(None, query_daemon(os.path.join(self.socket_dir, "missing.sock"), {"command": "list"}))
+
+
+class TestFastStart(UnsetSkytapEnvironmentVarsTestCase):
+    #microseconds; cumulative "python -X importtime" cost of importing skytap_inventory
+    IMPORT_TIME_BUDGET_US = 50000
+    HEAVY_MODULES = ("requests", "six", "logging", "argparse", "threading", "socket")
+
+    def setUp(self):
+        UnsetSkytapEnvironmentVarsTestCase.setUp(self)
+        self.cache_dir = tempfile.mkdtemp()
+        os.environ['SKYTAP_INI'] = os.path.abspath("tests/config_fixtures/config_fixture_with_creds.ini")
+        os.environ['SKYTAP_CACHE_PATH'] = self.cache_dir
+        os.environ['SKYTAP_CACHE_TTL'] = '300'
+        os.environ['SKYTAP_DAEMON_SOCKET'] = os.path.join(self.cache_dir, "no-daemon.sock")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        UnsetSkytapEnvironmentVarsTestCase.tearDown(self)
+
+    def run_python(self, code, *options):
+        process = subprocess.Popen([sys.executable] + list(options) + ["-c", code], stdout=subprocess.PIPE, 
+                                   stderr=subprocess.PIPE, env=dict(os.environ))
+        stdout, stderr = process.communicate()
+        return stdout.decode("utf-8"), stderr.decode("utf-8")
+
+    def test_import_is_light(self):
+        stdout, _ = self.run_python("import sys; preloaded = set(sys.modules); import json, skytap_inventory; "
+                                    "print(json.dumps([ m for m in %r if m in sys.modules and m not in preloaded ]))" % (self.HEAVY_MODULES,))
+        self.assertEqual([], json.loads(stdout))
+
+    def test_fast_start_answers_without_heavy_imports(self):
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            api_response = json.loads(api_fh.read())
+        test_inv = SkytapInventory()
+        test_inv.get_data = MagicMock(return_value=api_response)
+        expected = test_inv.get_inventory()
+
+        stdout, _ = self.run_python("import sys; preloaded = set(sys.modules); import json, skytap_inventory; "
+                                    "sys.argv = ['skytap_inventory.py', '--list']; skytap_inventory.main(); "
+                                    "print(json.dumps([ m for m in %r if m in sys.modules and m not in preloaded ]))" % (self.HEAVY_MODULES,))
+        inventory_line, modules_line = stdout.strip().split("\n")
+        self.assertDictEqual(expected, json.loads(inventory_line))
+        self.assertEqual([], json.loads(modules_line))
+
+    def test_fast_start_keeps_output_format(self):
+        os.environ['SKYTAP_OUTPUT_FORMAT'] = 'compact'
+        test_inv = SkytapInventory()
+        test_inv.get_data = MagicMock(return_value=generate_configuration(2))
+        expected = test_inv.run_as_script()
+
+        from skytap_inventory import fast_start_response
+        actual = fast_start_response(["--list"])
+        self.assertDictEqual(json.loads(expected), json.loads(actual))
+        self.assertFalse(", " in actual or ": " in actual)
+        self.assertEqual('{"ansible_ssh_host":"100.0.0.0"}', fast_start_response(["--host", "host-0-0"]))
+
+    def test_fast_start_ignores_other_settings(self):
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            api_response = json.loads(api_fh.read())
+        test_inv = SkytapInventory()
+        test_inv.get_data = MagicMock(return_value=api_response)
+        test_inv.get_inventory()
+
+        from skytap_inventory import fast_start_response
+        self.assertNotEqual(None, fast_start_response(["--host", "xyz1"]))
+        self.assertEqual(None, fast_start_response(["--list", "--refresh-cache"]))
+        os.environ['SKYTAP_NETWORK_TYPE'] = 'private'
+        self.assertEqual(None, fast_start_response(["--list"]))
+
+    def test_unwritable_fast_start_path(self):
+        blocker = os.path.join(self.cache_dir, "not-a-directory")
+        open(blocker, "w").close()
+        test_inv = SkytapInventory()
+        test_inv.get_data = MagicMock(return_value=generate_configuration(2))
+        with mock.patch("skytap_inventory.fast_start_path", return_value=os.path.join(blocker, "last-inventory.json")):
+            with mock.patch("skytap_inventory.LOG") as mock_log:
+                actual = test_inv.get_inventory()
+        self.assertEqual([u"host-0-0", u"host-1-0"], sorted(actual[u"_meta"][u"hostvars"]))
+        self.assertTrue(mock_log.warning.called)
+
+    def test_settings_override_gets_no_fast_start_record(self):
+        from skytap_inventory import fast_start_path
+        test_inv = SkytapInventory(settings={"skytap_env_vars": {"network_type": "private"}})
+        test_inv.get_data = MagicMock(return_value=generate_configuration(1))
+        test_inv.get_inventory()
+        self.assertFalse(os.path.exists(fast_start_path()))
+
+    @unittest.skipIf(sys.version_info < (3, 7), "python -X importtime needs Python 3.7+")
+    def test_import_time_budget(self):
+        self.run_python("import skytap_inventory")  #warm the bytecode cache
+        _, stderr = self.run_python("import skytap_inventory", "-X", "importtime")
+        cumulative = [ int(line.split("|")[1]) for line in stderr.splitlines() if line.rstrip().endswith("| skytap_inventory") ]
+        self.assertEqual(1, len(cumulative))
+        self.assertTrue(cumulative[0] < self.IMPORT_TIME_BUDGET_US, "import took %dus" % cumulative[0])
+
+
+class TestMetrics(UnsetSkytapEnvironmentVarsTestCase):
+    def setUp(self):
+        UnsetSkytapEnvironmentVarsTestCase.setUp(self)
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            self.api_response = json.loads(api_fh.read())
+
+    def test_stages_and_counters(self):
+        metrics = Metrics()
+        with metrics.stage("build"):
+            pass
+        metrics.count("retries", 2)
+        metrics.count("retries")
+        self.assertEqual(["build"], list(metrics.as_dict()["stage_seconds"]))
+        self.assertEqual({"retries": 3}, metrics.as_dict()["counters"])
+        self.assertTrue("skytap_inventory_retries 3\n" in metrics.prometheus_text())
+        self.assertTrue('skytap_inventory_stage_seconds{stage="build"}' in metrics.prometheus_text())
+
+    def test_client_counts_requests_and_bytes(self):
+        client = Client("https://_testfixture_.net/", "user", "token")
+        response = MagicMock(content=b'{"vms": []}', status_code=200)
+        response.raw.retries.history = ("first attempt",)
+        response.json.return_value = {"vms": []}
+        client.session.get = MagicMock(return_value=response)
+
+        self.assertEqual({"vms": []}, client.get("configurations/1.json"))
+        counters = client.metrics.as_dict()["counters"]
+        self.assertEqual({"requests": 1, "retries": 1, "bytes_received": 11}, counters)
+        self.assertEqual(set(["http_request", "json_decode"]), set(client.metrics.as_dict()["stage_seconds"]))
+
+    @mock.patch("sys.stderr")
+    def test_report_metrics(self, mock_stderr):
+        metrics_dir = tempfile.mkdtemp()
+        try:
+            os.environ['SKYTAP_METRICS'] = '1'
+            os.environ['SKYTAP_METRICS_TEXTFILE'] = os.path.join(metrics_dir, "skytap_inventory.prom")
+            test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+            test_inv.get_data = MagicMock(return_value=self.api_response)
+            test_inv.run_as_script()
+            test_inv.report_metrics()
+
+            reported = json.loads(mock_stderr.write.call_args[0][0])
+            self.assertEqual(set(["config_read", "build", "get_inventory", "serialize"]), set(reported["stage_seconds"]))
+            with open(os.path.join(metrics_dir, "skytap_inventory.prom"), "r") as prom_fh:
+                self.assertTrue('stage="serialize"' in prom_fh.read())
+        finally:
+            shutil.rmtree(metrics_dir)
+
+
+class TestResilience(UnsetSkytapEnvironmentVarsTestCase):
+    def setUp(self):
+        UnsetSkytapEnvironmentVarsTestCase.setUp(self)
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            self.api_response = json.loads(api_fh.read())
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        UnsetSkytapEnvironmentVarsTestCase.tearDown(self)
+
+    def test_retry_policy_backoff_and_retry_after(self):
+        from urllib3.util.retry import RequestHistory
+        policy = retry_policy(5, 0.5, 60)
+        self.assertTrue(429 in policy.status_forcelist and 503 in policy.status_forcelist)
+        policy = policy.new(history=tuple(RequestHistory("GET", "/", None, 503, None) for _ in range(4)))
+        for _ in range(20):
+            self.assertTrue(0 <= policy.get_backoff_time() <= 0.5 * (2 ** 3))
+
+        throttled = MagicMock(status=429, headers={"Retry-After": "3600"})
+        throttled.getheader.return_value = "3600"
+        self.assertEqual(60, policy.get_retry_after(throttled))
+
+    def test_timeouts_follow_deadline(self):
+        import requests
+        client = Client("https://_testfixture_.net/", "user", "token", connect_timeout=5, read_timeout=30)
+        self.assertEqual((5, 30), client.timeout())
+        client.start_deadline(2)
+        connect_timeout, read_timeout = client.timeout()
+        self.assertTrue(connect_timeout <= 2 and read_timeout <= 2)
+        client.deadline = time.time() - 1
+        self.assertRaises(requests.Timeout, client.timeout)
+
+    def test_circuit_breaker_serves_last_good_inventory(self):
+        import requests
+        os.environ['SKYTAP_CACHE_PATH'] = self.cache_dir
+        os.environ['SKYTAP_BREAKER_THRESHOLD'] = '2'
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv.get_data = MagicMock(return_value=self.api_response)
+        expected = json.loads(json.dumps(test_inv.get_inventory()))
+
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv.get_data = MagicMock(side_effect=requests.ConnectionError("API unavailable"))
+        with mock.patch("sys.stderr"):
+            self.assertDictEqual(expected, test_inv.get_inventory())
+            self.assertTrue(test_inv.circuit_breaker.allow())
+            self.assertDictEqual(expected, test_inv.get_inventory())
+            self.assertFalse(test_inv.circuit_breaker.allow())
+
+            #open circuit: the API isn't called at all
+            test_inv.get_data.reset_mock()
+            self.assertDictEqual(expected, test_inv.get_inventory())
+            self.assertFalse(test_inv.get_data.called)
+
+    def test_failure_without_breaker_raises(self):
+        import requests
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv.get_data = MagicMock(side_effect=requests.ConnectionError("API unavailable"))
+        self.assertRaises(requests.ConnectionError, test_inv.get_inventory)
+
+    def test_configuration_error_not_served_from_last_good(self):
+        os.environ['SKYTAP_CACHE_PATH'] = self.cache_dir
+        os.environ['SKYTAP_BREAKER_THRESHOLD'] = '2'
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv.get_data = MagicMock(return_value=self.api_response)
+        test_inv.get_inventory()
+
+        os.environ['SKYTAP_PROBE'] = 'bogus'
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+        test_inv.get_data = MagicMock(return_value=self.api_response)
+        self.assertRaises(ValueError, test_inv.get_inventory)
+        self.assertTrue(test_inv.circuit_breaker.allow())
+
+    def test_breaker_files_live_in_the_expanded_cache_path(self):
+        os.environ['SKYTAP_TEST_CACHE_DIR'] = self.cache_dir
+        os.environ['SKYTAP_CACHE_PATH'] = os.path.join("$SKYTAP_TEST_CACHE_DIR", "skytap")
+        os.environ['SKYTAP_BREAKER_THRESHOLD'] = '2'
+        try:
+            test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+            test_inv.get_data = MagicMock(return_value=self.api_response)
+            test_inv.get_inventory()
+            test_inv.circuit_breaker.record_failure()
+        finally:
+            del os.environ['SKYTAP_TEST_CACHE_DIR']
+        cache_files = os.listdir(os.path.join(self.cache_dir, "skytap"))
+        self.assertTrue("circuit.json" in cache_files)
+        self.assertTrue(any(name.endswith(".last-good.json") for name in cache_files))
+
+
+class TestChangeDetection(UnsetSkytapEnvironmentVarsTestCase):
+    def setUp(self):
+        UnsetSkytapEnvironmentVarsTestCase.setUp(self)
+        self.cache_dir = tempfile.mkdtemp()
+        os.environ['SKYTAP_CACHE_PATH'] = self.cache_dir
+        self.payload = generate_configuration(3)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        UnsetSkytapEnvironmentVarsTestCase.tearDown(self)
+
+    def build(self, changed_only=False):
+        test_inv = SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini", changed_only=changed_only)
+        test_inv.get_data = MagicMock(return_value=json.loads(json.dumps(self.payload)))
+        return json.loads(test_inv.run_as_script())
+
+    def test_changed_group(self):
+        os.environ['SKYTAP_CHANGE_DETECTION'] = 'true'
+        self.assertEqual([u"host-0-0", u"host-1-0", u"host-2-0"], self.build()[u"skytap_changed"][u"hosts"])
+        self.assertEqual([], self.build()[u"skytap_changed"][u"hosts"])
+
+        self.payload["vms"][1]["credentials"] = [{"id": "0000000", "text": "_FAKEUSER_ / rotated"}]
+        self.payload["vms"][2]["interfaces"][0]["nat_addresses"]["vpn_nat_addresses"][0]["ip_address"] = "100.9.9.9"
+        self.assertEqual([u"host-1-0", u"host-2-0"], self.build()[u"skytap_changed"][u"hosts"])
+
+    def test_changed_only(self):
+        self.build(changed_only=True)
+        self.payload["vms"][0]["interfaces"][0]["ip"] = "10.9.9.9"
+        actual = self.build(changed_only=True)
+        self.assertEqual([u"host-0-0"], actual[u"skytap_environment"][u"hosts"])
+        self.assertEqual([u"host-0-0"], list(actual[u"_meta"][u"hostvars"]))
+
+    def test_hosts_dropped_by_probe_filter_stay_changed(self):
+        def drop_host_1(test_inv, inventory):
+            for group_name, group in inventory.items():
+                if group_name != u"_meta":
+                    group[u"hosts"] = [ hostname for hostname in group[u"hosts"] if hostname != u"host-1-0" ]
+            inventory[u"_meta"][u"hostvars"].pop(u"host-1-0")
+            return inventory
+
+        os.environ['SKYTAP_CHANGE_DETECTION'] = 'true'
+        os.environ['SKYTAP_PROBE'] = 'filter'
+        with mock.patch.object(SkytapInventory, "probe_hosts", side_effect=drop_host_1, autospec=True):
+            self.assertEqual([u"host-0-0", u"host-2-0"], self.build()[u"skytap_changed"][u"hosts"])
+        del os.environ['SKYTAP_PROBE']
+        self.assertEqual([u"host-1-0"], self.build()[u"skytap_changed"][u"hosts"])
+
+    def test_off_by_default(self):
+        self.assertFalse(u"skytap_changed" in self.build())
+
+
+class TestReachabilityProbe(UnsetSkytapEnvironmentVarsTestCase):
+    def setUp(self):
+        import socket
+        UnsetSkytapEnvironmentVarsTestCase.setUp(self)
+        self.cache_dir = tempfile.mkdtemp()
+        os.environ['SKYTAP_CACHE_PATH'] = self.cache_dir
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(8)
+        #a port nothing listens on: bound, but never listening, so connects are refused
+        self.closed = socket.socket()
+        self.closed.bind(("127.0.0.1", 0))
+
+    def tearDown(self):
+        self.listener.close()
+        self.closed.close()
+        shutil.rmtree(self.cache_dir)
+        UnsetSkytapEnvironmentVarsTestCase.tearDown(self)
+
+    def inventory(self):
+        return {u"skytap_environment": {u"hosts": [u"up", u"down"], u"vars": {u"ansible_ssh_port": u"22"}},
+                u"web_tier": {u"hosts": [u"down"], u"vars": {}},
+                u"_meta": {u"hostvars": {u"up": {u"ansible_ssh_host": u"127.0.0.1", u"ansible_ssh_port": self.listener.getsockname()[1]},
+                                         u"down": {u"ansible_ssh_host": u"127.0.0.1", u"ansible_ssh_port": self.closed.getsockname()[1]}}}}
+
+    def probing_inventory(self, mode):
+        os.environ['SKYTAP_PROBE'] = mode
+        return SkytapInventory(None,None,None,"tests/config_fixtures/config_fixture_with_creds.ini")
+
+    def test_hosts_behind_bastion_are_not_probed(self):
+        inventory = self.inventory()
+        inventory[u"_meta"][u"hostvars"][u"down"][u"ansible_ssh_common_args"] = u"-o ProxyJump=jump@bastion.example.com"
+        actual = self.probing_inventory("group").probe_hosts(inventory)
+        self.assertEqual([u"up"], actual[u"skytap_reachable"][u"hosts"])
+        self.assertEqual([], actual[u"skytap_unreachable"][u"hosts"])
+
+        inventory = self.inventory()
+        inventory[u"_meta"][u"hostvars"][u"down"][u"ansible_ssh_common_args"] = u"-o ProxyJump=jump@bastion.example.com"
+        actual = self.probing_inventory("filter").probe_hosts(inventory)
+        self.assertEqual([u"up", u"down"], actual[u"skytap_environment"][u"hosts"])
+
+    def test_fast_start_expires_with_probe_results(self):
+        from skytap_inventory import fast_start_path
+        os.environ['SKYTAP_CACHE_TTL'] = '300'
+        os.environ['SKYTAP_PROBE_CACHE_TTL'] = '30'
+        test_inv = self.probing_inventory("filter")
+        test_inv.store_fast_start(self.inventory())
+        with open(fast_start_path(), "r") as record_fh:
+            expires = json.load(record_fh)["expires"]
+        self.assertTrue(expires <= time.time() + 30)
+
+    def test_probe_groups(self):
+        actual = self.probing_inventory("group").probe_hosts(self.inventory())
+        self.assertEqual([u"up"], actual[u"skytap_reachable"][u"hosts"])
+        self.assertEqual([u"down"], actual[u"skytap_unreachable"][u"hosts"])
+
+    def test_probe_filter(self):
+        actual = self.probing_inventory("filter").probe_hosts(self.inventory())
+        self.assertEqual([u"up"], actual[u"skytap_environment"][u"hosts"])
+        self.assertEqual([], actual[u"web_tier"][u"hosts"])
+        self.assertEqual([u"up"], list(actual[u"_meta"][u"hostvars"]))
+
+    def test_probe_results_cached(self):
+        self.probing_inventory("group").probe_hosts(self.inventory())
+        with mock.patch("socket.create_connection") as mock_connect:
+            actual = self.probing_inventory("group").probe_hosts(self.inventory())
+        self.assertFalse(mock_connect.called)
+        self.assertEqual([u"down"], actual[u"skytap_unreachable"][u"hosts"])
+
+    def test_probe_off(self):
+        self.assertEqual(None, self.probing_inventory("false").probe_mode())
+
+
+class TestFakeSkytapServer(UnsetSkytapEnvironmentVarsTestCase):
+    """Client and SkytapInventory over HTTP, against the local stand-in for the Skytap API"""
+    CREDENTIALS = ("_SKYTAP-USERNAME_", "abcdefghijklmnopqrstuvwxyz01234567890abcef")
+
+    def setUp(self):
+        UnsetSkytapEnvironmentVarsTestCase.setUp(self)
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            self.api_response = json.loads(api_fh.read())
+        with open("tests/dynamic_inventory_fixture_with_api_creds.json", "r") as inv_fh:
+            self.expected_inventory = json.loads(inv_fh.read())
+        self.cache_dir = tempfile.mkdtemp()
+        #keep fast-start records (and any subprocess's) out of the real cache directory
+        os.environ['SKYTAP_CACHE_PATH'] = self.cache_dir
+        self.server = FakeSkytapServer({"0000000": self.api_response}, credentials=self.CREDENTIALS).start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.cache_dir)
+        UnsetSkytapEnvironmentVarsTestCase.tearDown(self)
+
+    def inventory(self, configuration_id=None, **runtime_vars):
+        runtime_vars.setdefault("backoff_factor", 0.001)
+        runtime_vars.setdefault("cache_path", self.cache_dir)
+        return SkytapInventory(configuration_id, None, None, "tests/config_fixtures/config_fixture_with_creds.ini", 
+                               settings={"skytap_vars": {"base_url": self.server.url}, "skytap_runtime_vars": runtime_vars})
+
+    def test_inventory_over_http(self):
+        self.assertDictEqual(self.expected_inventory, self.inventory().get_inventory())
+        self.assertEqual(["/configurations/0000000.json"], self.server.requests)
+
+    def test_streamed_inventory_over_http(self):
+        self.assertDictEqual(self.expected_inventory, self.inventory(stream_parse=True).get_inventory())
+
+    def test_vm_fetch_strategy_over_http(self):
+        self.assertDictEqual(self.expected_inventory, self.inventory(fetch_strategy="vms").get_inventory())
+        self.assertEqual(["/configurations/0000000/vms.json"], [ path.split("?")[0] for path in self.server.requests ])
+
+    def test_vm_fetch_strategy_pages(self):
+        self.server.configurations["0000000"] = generate_configuration(25, credentials_per_vm=1)
+        expected = self.inventory().get_inventory()
+        del self.server.requests[:]
+        test_inv = self.inventory(fetch_strategy="vms", page_size=10, max_workers=4, cache_ttl=300)
+
+        self.assertDictEqual(expected, test_inv.get_inventory())
+        self.assertEqual(3, len(self.server.requests))
+        self.assertTrue(all(path.startswith("/configurations/0000000/vms.json?") for path in self.server.requests))
+        #the assembled document is cached like a configuration response
+        self.assertDictEqual(expected, self.inventory(fetch_strategy="vms", page_size=10, cache_ttl=300).get_inventory())
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_vm_fetch_strategy_tunnels_and_tags(self):
+        tunnel = {"id": "tunnel-1", "source_network": {"url": "%s/configurations/1111111/networks/0000000" % FIXTURE_URL}}
+        payload = generate_configuration(3, icnr_nats=2)
+        payload["tunnels"] = [tunnel]
+        payload["tags"] = [{"id": "1", "value": "ci-pool"}]
+        self.server.configurations["0000000"] = payload
+        self.server.tunnels["tunnel-1"] = tunnel
+        settings = {"skytap_vars": {"base_url": self.server.url},
+                    "skytap_env_vars": {"network_type": "nat_icnr", "network_connection_id": "tunnel-1"},
+                    "skytap_runtime_vars": {"cache_path": self.cache_dir}}
+        expected = SkytapInventory(None, None, None, "tests/config_fixtures/config_fixture_groups.ini", settings=settings).get_inventory()
+        settings["skytap_runtime_vars"]["fetch_strategy"] = "vms"
+        actual = SkytapInventory(None, None, None, "tests/config_fixtures/config_fixture_groups.ini", settings=settings).get_inventory()
+
+        self.assertDictEqual(expected, actual)
+        self.assertEqual([u"host-0-0", u"host-1-0", u"host-2-0"], sorted(actual[u"skytap_tag_ci_pool"][u"hosts"]))
+        self.assertEqual(u"150.0.0.0", actual[u"_meta"][u"hostvars"][u"host-0-0"][u"ansible_ssh_host"])
+        self.assertIn("/tunnels/tunnel-1.json", self.server.requests)
+        self.assertIn("/configurations/0000000/tags.json", self.server.requests)
+
+    def test_vm_fetch_strategy_cache_follows_tunnel_and_tags(self):
+        tunnel = {"id": "tunnel-1", "source_network": {"url": "%s/configurations/1111111/networks/0000000" % FIXTURE_URL}}
+        payload = generate_configuration(3, icnr_nats=2)
+        payload["tags"] = [{"id": "1", "value": "ci-pool"}]
+        self.server.configurations["0000000"] = payload
+        self.server.tunnels["tunnel-1"] = tunnel
+        settings = {"skytap_vars": {"base_url": self.server.url},
+                    "skytap_env_vars": {"network_type": "nat_icnr"},
+                    "skytap_runtime_vars": {"cache_path": self.cache_dir, "cache_ttl": 300, "fetch_strategy": "vms"}}
+        SkytapInventory(None, None, None, "tests/config_fixtures/config_fixture_with_creds.ini", settings=settings).get_inventory()
+
+        #a tunnel and a tag group rule the cached document was built without
+        settings["skytap_env_vars"]["network_connection_id"] = "tunnel-1"
+        actual = SkytapInventory(None, None, None, "tests/config_fixtures/config_fixture_groups.ini", settings=settings).get_inventory()
+        self.assertEqual([u"host-0-0", u"host-1-0", u"host-2-0"], sorted(actual[u"skytap_tag_ci_pool"][u"hosts"]))
+        self.assertEqual(u"150.0.0.0", actual[u"_meta"][u"hostvars"][u"host-0-0"][u"ansible_ssh_host"])
+
+    def test_streamed_request_is_timed(self):
+        test_inv = self.inventory(stream_parse=True)
+        test_inv.get_inventory()
+        self.assertTrue("http_request" in test_inv.metrics.as_dict()["stage_seconds"])
+
+    def test_failed_run_reports_metrics(self):
+        import requests
+        import skytap_inventory
+        os.environ['SKYTAP_INI'] = os.path.abspath("tests/config_fixtures/config_fixture_with_creds.ini")
+        os.environ['SKYTAP_BASE_URL'] = self.server.url
+        os.environ['SKYTAP_METRICS'] = 'true'
+        os.environ['SKYTAP_MAX_RETRIES'] = '0'
+        os.environ['SKYTAP_DAEMON_SOCKET'] = os.path.join(self.cache_dir, "no-daemon.sock")
+        self.server.queue_faults(503)
+        stderr = six.StringIO()
+        with mock.patch("sys.stderr", new=stderr), mock.patch("sys.stdout", new=six.StringIO()):
+            self.assertRaises(requests.HTTPError, skytap_inventory.main, ["--list"])
+        metrics = json.loads(stderr.getvalue().strip().splitlines()[-1])
+        self.assertEqual(1, metrics["counters"]["requests"])
+
+    def test_retries_throttling_and_server_errors(self):
+        self.server.queue_faults(429, 503, 502)
+        test_inv = self.inventory()
+        self.assertDictEqual(self.expected_inventory, test_inv.get_inventory())
+        self.assertEqual(4, len(self.server.requests))
+        self.assertEqual(3, test_inv.metrics.as_dict()["counters"]["retries"])
+
+    def test_retries_exhausted(self):
+        import requests
+        self.server.queue_faults(503, 503, 503)
+        self.assertRaises(requests.HTTPError, self.inventory(max_retries=2).get_inventory)
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_deadline_bounds_retries(self):
+        import requests
+        self.server.retry_after = 2
+        self.server.queue_faults(429, 429, 429)
+        test_inv = self.inventory(deadline=1)
+        started = time.time()
+        self.assertRaises(requests.HTTPError, test_inv.get_inventory)
+        elapsed = time.time() - started
+        self.assertTrue(elapsed < 1.5, "took %.1fs" % elapsed)
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_read_timeout(self):
+        import requests
+        self.server.latency = 0.5
+        self.assertRaises(requests.RequestException, self.inventory(max_retries=0, read_timeout=0.1).get_inventory)
+
+    def test_truncated_body_served_from_last_good(self):
+        self.inventory(breaker_threshold=5).get_inventory()
+        self.server.queue_faults("truncate")
+        with mock.patch("sys.stderr"):
+            self.assertDictEqual(self.expected_inventory, self.inventory(breaker_threshold=5).get_inventory())
+
+    def test_cached_response_revalidated(self):
+        self.inventory(cache_ttl=60).get_inventory()
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".response.json"):
+                entry = json.load(open(os.path.join(self.cache_dir, name)))
+                entry["timestamp"] = 0
+                json.dump(entry, open(os.path.join(self.cache_dir, name), "w"))
+        with mock.patch("skytap_inventory.fast_start_path", return_value=os.path.join(self.cache_dir, "fast-start.json")):
+            self.assertDictEqual(self.expected_inventory, self.inventory(cache_ttl=60).get_inventory())
+        self.assertEqual(2, len(self.server.requests))
+
+    def test_concurrent_environments_with_faults(self):
+        self.server.configurations = dict( (str(config_id), self.api_response) for config_id in range(1, 9) )
+        self.server.latency = 0.05
+        self.server.error_rate = 0.3
+        self.server.throttle_rate = 0.2
+        actual = self.inventory(u",".join(self.server.configurations), max_workers=8, max_retries=30).get_inventory()
+
+        self.assertEqual(8, len(actual[u"skytap_environment"][u"hosts"]))
+        self.assertTrue(self.server.max_in_flight > 1)
+
+    def test_discovery_pages(self):
+        self.server.listing = [ {"id": str(index), "name": "ci-%d" % index, "tags": []} for index in range(250) ]
+        self.server.configurations = dict( (environment["id"], self.api_response) for environment in self.server.listing )
+        actual = self.inventory(discover_name="ci-24*", page_size=100, max_workers=4).get_inventory()
+
+        self.assertEqual(3, len([ path for path in self.server.requests if path.startswith("/configurations.json") ]))
+        self.assertEqual(11, len(actual[u"skytap_environment"][u"hosts"]))
+        self.assertTrue(u"ci_245" in actual)
+
+    def test_large_configuration_throughput(self):
+        payload = generate_configuration(2000, interfaces_per_vm=2)
+        self.server.configurations = {"0000000": payload}
+        inventories = []
+        for stream_parse in (False, True):
+            test_inv = self.inventory(stream_parse=stream_parse)
+            inventories.append(test_inv.get_inventory())
+            self.assertEqual(4000, len(inventories[-1][u"_meta"][u"hostvars"]))
+            self.assertEqual(len(json.dumps(payload)), test_inv.metrics.as_dict()["counters"]["bytes_received"])
+        self.assertDictEqual(inventories[0], inventories[1])
+
+    def concurrent_inventories(self, processes, **runtime_vars):
+        """get_inventory() from several processes started together, with single_flight on"""
+        runtime_vars.update(single_flight=True, cache_path=self.cache_dir)
+        script = ("import json, sys; from skytap_inventory import SkytapInventory; "
+                  "inventory = SkytapInventory(None, None, None, 'tests/config_fixtures/config_fixture_with_creds.ini', "
+                  "settings={'skytap_vars': {'base_url': %r}, 'skytap_runtime_vars': %r}); "
+                  "sys.stdout.write(json.dumps(inventory.get_inventory()))" % (self.server.url, runtime_vars))
+        running = [ subprocess.Popen([sys.executable, "-c", script], stdout=subprocess.PIPE) for _ in range(processes) ]
+        return [ json.loads(process.communicate()[0].decode("utf-8")) for process in running ]
+
+    def test_single_flight_across_processes(self):
+        self.server.latency = 0.5
+        outputs = self.concurrent_inventories(6)
+
+        self.assertEqual(["/configurations/0000000.json"], self.server.requests)
+        for output in outputs:
+            self.assertDictEqual(self.expected_inventory, output)
+
+    def test_single_flight_with_vm_fetch_strategy(self):
+        self.server.latency = 0.5
+        outputs = self.concurrent_inventories(6, fetch_strategy="vms")
+
+        self.assertEqual(["/configurations/0000000/vms.json"], [ path.split("?")[0] for path in self.server.requests ])
+        for output in outputs:
+            self.assertDictEqual(self.expected_inventory, output)
+
+    def test_enrichment_over_http(self):
+        self.server.vm_resources = {("0000000", "user_data"): {"contents": "#cloud-config"}}
+        actual = self.inventory(enrich_resources="user_data, metadata").get_inventory()
+        self.assertEqual({"contents": "#cloud-config"}, actual[u"_meta"][u"hostvars"][u"xyz1"][u"skytap_user_data"])
+        self.assertFalse(u"skytap_metadata" in actual[u"_meta"][u"hostvars"][u"xyz1"])
+
+
+try:
+    from ansible.inventory.data import InventoryData
+    from ansible.parsing.dataloader import DataLoader
+    from ansible.plugins.loader import inventory_loader
+    inventory_loader.add_directory(os.path.abspath("inventory_plugins"))
+except ImportError:
+    inventory_loader = None
+
+@unittest.skipIf(inventory_loader is None, "ansible is not installed")
+class TestInventoryPlugin(UnsetSkytapEnvironmentVarsTestCase):
+    def setUp(self):
+        UnsetSkytapEnvironmentVarsTestCase.setUp(self)
+        with open("tests/api_response_fixture.json", "r") as api_fh:
+            self.api_response = json.loads(api_fh.read())
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        UnsetSkytapEnvironmentVarsTestCase.tearDown(self)
+
+    def parse(self, path, cache=True):
+        plugin = inventory_loader.get("skytap")
+        inventory = InventoryData()
+        with mock.patch("skytap_inventory.SkytapInventory.get_data", return_value=self.api_response) as mock_get_data:
+            plugin.parse(inventory, DataLoader(), path, cache=cache)
+            #as Ansible's InventoryManager does after each source
+            if getattr(plugin, "_cache", None) is not None and hasattr(plugin, "update_cache_if_changed"):
+                plugin.update_cache_if_changed()
+        return inventory, mock_get_data.call_count
+
+    def test_hosts_groups_and_constructed_vars(self):
+        inventory, _ = self.parse("tests/config_fixtures/inventory_fixture.skytap.yml")
+        host_vars = inventory.get_host("xyz1").get_vars()
+
+        self.assertEqual(u"_FAKEUSER_", host_vars["ansible_ssh_user"])
+        self.assertEqual(u"web", host_vars["tier"])
+        self.assertTrue("skytap_environment" in inventory.groups and "ssh_user__FAKEUSER_" in inventory.groups)
+        self.assertEqual(u"_ANSIBLE-SSH-USER_", inventory.groups["skytap_environment"].get_vars()["ansible_ssh_user"])
+
+    def test_settings_file_defaults_to_the_script_lookup(self):
+        import skytap_inventory
+        path = os.path.join(self.cache_dir, "default.skytap.yml")
+        with open("tests/config_fixtures/inventory_fixture.skytap.yml", "r") as fixture_fh:
+            config = "".join( line for line in fixture_fh if not line.startswith("settings_file:") )
+        with open(path, "w") as config_fh:
+            config_fh.write(config)
+        os.environ['SKYTAP_INI'] = os.path.abspath("tests/config_fixtures/config_fixture_with_creds.ini")
+
+        with mock.patch("skytap_inventory.settings_path", wraps=skytap_inventory.settings_path) as mock_settings_path:
+            inventory, _ = self.parse(path)
+        mock_settings_path.assert_called_with(None)
+        self.assertEqual(["xyz1"], [ host.name for host in inventory.groups["skytap_environment"].get_hosts() ])
+
+    def test_cache_plugin(self):
+        path = os.path.join(self.cache_dir, "cached.skytap.yml")
+        with open("tests/config_fixtures/inventory_fixture.skytap.yml", "r") as fixture_fh:
+            config = fixture_fh.read().replace("settings_file: ", "settings_file: " + os.getcwd() + "/")
+        with open(path, "w") as config_fh:
+            config_fh.write(config + "cache: true\ncache_plugin: jsonfile\ncache_connection: %s\n" % self.cache_dir)
+
+        self.assertEqual(1, self.parse(path)[1])
+        inventory, api_calls = self.parse(path)
+        self.assertEqual(0, api_calls)
+        self.assertEqual(["xyz1"], [ host.name for host in inventory.groups["skytap_environment"].get_hosts() ])
+        self.assertEqual(1, self.parse(path, cache=False)[1])
+
+
 if __name__ == "__main__":
     instantiationMethodsSuite = unittest.TestLoader().loadTestsFromTestCase(TestInstantiationMethods)
     parseMethodsSuite = unittest.TestLoader().loadTestsFromTestCase(TestParseMethods)
     runtimeMethodsSuite = unittest.TestLoader().loadTestsFromTestCase(TestRuntimeMethods)
+    responseCacheSuite = unittest.TestLoader().loadTestsFromTestCase(TestResponseCache)
+    inventoryDaemonSuite = unittest.TestLoader().loadTestsFromTestCase(TestInventoryDaemon)
+    fastStartSuite = unittest.TestLoader().loadTestsFromTestCase(TestFastStart)
+    metricsSuite = unittest.TestLoader().loadTestsFromTestCase(TestMetrics)
+    resilienceSuite = unittest.TestLoader().loadTestsFromTestCase(TestResilience)
+    changeDetectionSuite = unittest.TestLoader().loadTestsFromTestCase(TestChangeDetection)
+    reachabilityProbeSuite = unittest.TestLoader().loadTestsFromTestCase(TestReachabilityProbe)
+    fakeSkytapServerSuite = unittest.TestLoader().loadTestsFromTestCase(TestFakeSkytapServer)
+    inventoryPluginSuite = unittest.TestLoader().loadTestsFromTestCase(TestInventoryPlugin)
 
     unittest.TextTestRunner(verbosity=2).run(instantiationMethodsSuite)
     unittest.TextTestRunner(verbosity=2).run(parseMethodsSuite)
     unittest.TextTestRunner(verbosity=2).run(runtimeMethodsSuite)
+    unittest.TextTestRunner(verbosity=2).run(responseCacheSuite)
+    unittest.TextTestRunner(verbosity=2).run(inventoryDaemonSuite)
+    unittest.TextTestRunner(verbosity=2).run(fastStartSuite)
+    unittest.TextTestRunner(verbosity=2).run(metricsSuite)
+    unittest.TextTestRunner(verbosity=2).run(resilienceSuite)
+    unittest.TextTestRunner(verbosity=2).run(changeDetectionSuite)
+    unittest.TextTestRunner(verbosity=2).run(reachabilityProbeSuite)
+    unittest.TextTestRunner(verbosity=2).run(fakeSkytapServerSuite)
+    unittest.TextTestRunner(verbosity=2).run(inventoryPluginSuite)